@@ -8,10 +8,11 @@
     使得在Billfish中也能通过标签查找自己喜欢的作品
     参考自 @Coder-Sakura 的 pixiv2eagle
 """
-import json
-import re
+import queue
+import signal
 import sqlite3
 import os.path
+import threading
 import time
 import requests
 from loguru import logger
@@ -19,12 +20,25 @@ from loguru import logger
 # 强制取消警告
 requests.packages.urllib3.disable_warnings()
 
-from thread_pool import ThreadPool, callback
+from thread_pool import ThreadPool
+from meta_cache import MetaCache
+from rate_limiter import RateLimiter, LIMIT_STATUS, parse_retry_after
+from progress_journal import ProgressJournal
+from illust_parser import load_illust, build_tags, build_note, parse_batch
+from metrics import Metrics, MetricsServer, MetricsWriter
+from event_log import EventLog
+from tag_index import TagIndex
+from import_plan import ImportPlan, read_plan
+from batch_fetch import BatchFetcher
+from sidecar import SidecarIndex
 
 # Billfish 数据库目录
 # 注意在目录的" "外添加 r
 # e.g. DB_PATH = r"C:\pictures\.bf\billfish.db"
 DB_PATH = r"billfish.db"
+# 同时处理多个素材库，设置后忽略 DB_PATH，相同的pid只获取一次，结果分别写入各素材库
+# e.g. DB_PATHS = [r"C:\pictures\.bf\billfish.db", r"D:\illust\.bf\billfish.db"]
+DB_PATHS = []
 
 # 选择使用代理链接
 # useProxies = 1 使用http代理，useProxies = 0 禁用http代理
@@ -39,18 +53,68 @@ WRITE_NOTE = 1
 START_FILE_NUM = 0
 # 处理多少文件，0为直至结束
 END_FILE_NUM = 0
+# 每次从数据库读取的文件数，文件分块读取，内存占用不随素材库大小增长
+FILE_CHUNK = 1000
 # 选择是否跳过已有内容的数据
 SKIP = 1
-
-# TAG_Thread为标签线程，NOTE_Thread为备注线程
-TAG_Thread = 8
-NOTE_Thread = 8
-
-TAG_TOOL = ThreadPool(TAG_Thread)
-NOTE_TOOL = ThreadPool(NOTE_Thread)
-FOR_TOOL = ThreadPool(WRITE_TAG + WRITE_NOTE)
+# SKIP = 1 时，直接在数据库中查询缺少标签/备注的文件，已有内容的文件不再读取与处理
+PENDING_QUERY = 1
+# 记录处理进度，中断后再次运行时跳过已写入的文件，正常结束后清除记录
+# 进度记录保存于程序目录下的 PROGRESS_PATH 中
+RESUME = 1
+PROGRESS_PATH = "progress.db"
+
+# FETCH_Thread为获取作品信息的线程，每个作品只请求一次，同时用于写入标签与备注
+FETCH_Thread = 16
+# 等待获取的作品数上限，队列已满时暂停读取数据库
+FETCH_QUEUE_SIZE = 200
+# 程序被中断时，等待正在进行的任务结束的最长秒数
+CANCEL_TIMEOUT = 30
+
+FETCH_TOOL = ThreadPool(FETCH_Thread, FETCH_QUEUE_SIZE)
+
+# 获取作品信息的方式
+# FETCH_ENGINE = "thread" 使用多线程 FETCH_TOOL
+# FETCH_ENGINE = "async" 使用asyncio，共用一个连接池，可同时进行大量请求 (需额外安装 aiohttp)
+# FETCH_ENGINE = "batch" 使用多线程，只需要写入标签的作品按画师批量获取，需要备注的作品仍逐个获取
+FETCH_ENGINE = "thread"
+# async 模式下同时进行的最大请求数
+ASYNC_LIMIT = 64
+# batch 模式下每次请求的最大作品数
+BATCH_SIZE = 48
+# batch 模式下批量接口不包括标签翻译，含有翻译未知的标签的作品默认仍逐个获取
+# BATCH_LOSSY = 1 时直接使用批量结果，请求更少，但这些作品可能缺少英文标签
+BATCH_LOSSY = 0
+
+# 请求速率限制(次/秒)，所有线程共用
+# 请求成功时速率会逐渐提高至 RATE_LIMIT_MAX，遇到 429/403/超时 时减半并暂停一段时间
+# RATE_LIMIT = 0 时不限速
+RATE_LIMIT = 10
+RATE_LIMIT_MIN = 1
+RATE_LIMIT_MAX = 30
+
+# 作品信息缓存文件，保存于程序目录下，已获取过的作品不再重复请求pixiv
+# CACHE_PATH = "" 时不使用缓存
+CACHE_PATH = "pixiv_cache.db"
+# 缓存有效期(秒)，0为永不过期，默认30天
+CACHE_TTL = 30 * 24 * 3600
+# 缓存最大条数，超出时淘汰最久未使用的作品，0为不限制
+CACHE_MAX_ITEMS = 500000
+# 仅使用缓存，不请求pixiv，缓存中没有的作品视为获取失败
+OFFLINE = 0
+# 下载工具保存的本地元数据目录(如 PixivUtil2 的 JSON/txt、gallery-dl --write-metadata 的 JSON、/ajax/illust 原始内容)
+# 启动时扫描目录(包括子目录)中以pid开头的 .json/.txt 文件，有本地元数据的作品不请求pixiv，也不读取缓存
+# e.g. SIDECAR_PATHS = [r"D:\pixiv", r"D:\pixiv_meta"]
+SIDECAR_PATHS = []
+
+# 解析作品信息(生成标签与备注)的进程数，0为在获取线程中直接解析
+# 使用缓存重新写入大量文件时，解析为主要耗时，可设置为CPU核心数
+PARSE_PROCESS = 0
+# 每次交给解析进程的作品数
+PARSE_BATCH = 200
 
 temp_url = "https://www.pixiv.net/ajax/illust/"
+user_url = "https://www.pixiv.net/ajax/user/"
 origin_url = "https://www.pixiv.net/artworks/"
 # HEADERS
 headers = {
@@ -62,29 +126,73 @@ headers = {
                   'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/56.0.2924.87 Safari/537.36'
 }
 
-log_path = os.path.split(os.path.abspath(__file__))[0]
-# 日志写入
-logger.add(
-    os.path.join(log_path, "{time}.log"),
-    encoding="utf-8",
-    enqueue=True,
-)
-
-file_id_list = []
+# 所有请求共用一个Session，复用与pixiv的连接
+session = requests.Session()
+session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=FETCH_Thread))
+session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=FETCH_Thread))
 
-tag_id_list = []
-tag_name_list = []
-
-tag_join_file_file_id_list = []
-tag_join_file_tag_id_list = []
-
-note_file_id_list = []
-note_note_list = []
+log_path = os.path.split(os.path.abspath(__file__))[0]
+# 日志写入，解析进程(spawn)导入本文件时不重复创建日志文件
+if __name__ != "__mp_main__":
+    logger.add(
+        os.path.join(log_path, "{time}.log"),
+        encoding="utf-8",
+        enqueue=True,
+    )
 
-prepare_file = []
-prepare_tag = []
-prepare_tag_join_file = []
-prepare_note_join_file = []
+# 安静模式，QUIET = 1 时不再逐个文件输出日志，只输出错误、每 PROGRESS_INTERVAL 秒一次的进度与最终统计
+# 大量文件(尤其是使用缓存重新写入)时可明显减少耗时与日志体积
+QUIET = 0
+PROGRESS_INTERVAL = 10
+# 将每个作品的处理结果以 JSON Lines 追加写入程序目录下的 EVENT_LOG，"" 为不写入
+EVENT_LOG = ""
+
+meta_cache = None
+sidecar_index = None
+rate_limiter = None
+event_log = None
+
+# 运行指标，METRICS_PORT 不为0时可通过 http://127.0.0.1:METRICS_PORT/metrics 读取(Prometheus格式)
+# 或 http://127.0.0.1:METRICS_PORT/metrics.json 读取(JSON)
+METRICS_PORT = 0
+# 每 METRICS_INTERVAL 秒将指标快照追加写入程序目录下的 METRICS_PATH (JSON Lines)，"" 为不写入
+METRICS_PATH = ""
+METRICS_INTERVAL = 10
+metrics = Metrics()
+
+# 导入计划，可将耗时的获取阶段与写入数据库分开
+# PLAN = "write" 时正常读取数据库并获取作品信息，但不修改数据库，将要写入的标签与备注保存至程序目录下的 PLAN_PATH
+# PLAN = "apply" 时不请求pixiv，读取 PLAN_PATH 并在一个事务中写入数据库
+# PLAN = "" 为直接写入
+PLAN = ""
+PLAN_PATH = "plan.jsonl"
+# 计划文件由其他素材库生成时拒绝写入(文件id只在生成计划的素材库中有效)，PLAN_FORCE = 1 时仍写入
+PLAN_FORCE = 0
+
+# 监视模式，WATCH = 1 时处理完现有文件后持续运行，每 WATCH_INTERVAL 秒检查一次数据库，只处理新增的文件
+# 数据库没有变化时不进行查询，新增文件按每块 WATCH_BATCH 个读取
+WATCH = 0
+WATCH_INTERVAL = 5
+WATCH_BATCH = 500
+
+# 数据库被占用(如Billfish正在写入)时，等待的最长秒数
+BUSY_TIMEOUT = 30
+# 导入会话：写入期间使用一个长期连接，并调整以下设置以降低提交耗时，结束时恢复数据库原有的日志模式
+IMPORT_SESSION = 1
+# 日志模式，"" 为不修改。WAL 提交最快；素材库位于NAS等网络磁盘时 WAL 不可用，建议改为 "TRUNCATE"
+SESSION_JOURNAL_MODE = "WAL"
+# 同步模式，NORMAL 时每次提交不再等待数据完全落盘
+SESSION_SYNCHRONOUS = "NORMAL"
+# 页缓存大小，负数为KiB，默认256MB
+SESSION_CACHE_SIZE = -262144
+# 会话结束时恢复为 Billfish 使用的日志模式，上次运行中断未能恢复时也会在此次结束时恢复
+BILLFISH_JOURNAL_MODE = "DELETE"
+
+# 写入队列长度(以作品计)，队列满时获取线程会等待写入
+WRITE_QUEUE_SIZE = 2000
+# 组提交：积累 COMMIT_NUM 条内容，或距上次提交超过 COMMIT_INTERVAL 秒时，用一个事务批量写入
+COMMIT_NUM = 5000
+COMMIT_INTERVAL = 5
 
 
 def baseRequest(options, method="GET", data=None, params=None, retry_num=5):
@@ -105,9 +213,13 @@ def baseRequest(options, method="GET", data=None, params=None, retry_num=5):
     }
     baseRequest(options = options)
     """
-    if useProxies:
+    for _ in range(retry_num + 1):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        metrics.add("requests_in_flight", 1)
+        start = time.monotonic()
         try:
-            response = requests.request(
+            response = session.request(
                 method,
                 options["url"],
                 data=data,
@@ -116,38 +228,251 @@ def baseRequest(options, method="GET", data=None, params=None, retry_num=5):
                 headers=headers,
                 verify=False,
                 timeout=options.get("timeout", 5),
-                proxies=proxies
+                proxies=proxies if useProxies else None
             )
-            response.encoding = "utf8"
-            return response
-        except Exception as e:
-            if retry_num > 0:
+        except Exception:
+            metrics.inc("http_responses_total", status="error")
+            if rate_limiter is not None:
+                rate_limiter.on_limited()
+            else:
                 time.sleep(0.5)
-                return baseRequest(options, data, params, retry_num=retry_num - 1)
+            continue
+        finally:
+            metrics.add("requests_in_flight", -1)
+            metrics.observe("request_seconds", time.monotonic() - start)
+        metrics.inc("http_responses_total", status=response.status_code)
+        # 请求过于频繁，退避后重试
+        if response.status_code in LIMIT_STATUS:
+            if rate_limiter is not None:
+                rate_limiter.on_limited(parse_retry_after(response.headers.get("Retry-After")))
             else:
-                logger.info("网络请求超时 url:{}".format(options["url"]))
-                return 0
-    else:
-        try:
-            response = requests.request(
-                method,
-                options["url"],
-                data=data,
-                params=params,
-                cookies=options.get("cookies", ""),
-                headers=headers,
-                verify=False,
-                timeout=options.get("timeout", 5),
-            )
-            response.encoding = "utf8"
-            return response
-        except Exception as e:
-            if retry_num > 0:
                 time.sleep(0.5)
-                return baseRequest(options, data, params, retry_num=retry_num - 1)
+            continue
+        if rate_limiter is not None:
+            rate_limiter.on_success()
+        response.encoding = "utf8"
+        return response
+    logger.info("网络请求超时 url:{}".format(options["url"]))
+    return 0
+
+
+# 打开请求限速器
+def open_rate_limiter():
+    """
+    根据 RATE_LIMIT 创建全局共用的限速器，重复调用时返回已创建的限速器
+    :return: RateLimiter or None
+    """
+    global rate_limiter
+    if rate_limiter is None and RATE_LIMIT:
+        rate_limiter = RateLimiter(RATE_LIMIT, RATE_LIMIT_MIN, RATE_LIMIT_MAX)
+    return rate_limiter
+
+
+# 打开作品信息缓存
+def open_cache():
+    """
+    根据 CACHE_PATH 打开作品信息缓存，重复调用时返回已打开的缓存
+    :return: MetaCache or None
+    """
+    global meta_cache
+    if meta_cache is None and CACHE_PATH:
+        meta_cache = MetaCache(os.path.join(log_path, CACHE_PATH), CACHE_TTL, CACHE_MAX_ITEMS)
+    return meta_cache
+
+
+# 打开本地元数据索引
+def open_sidecar():
+    """
+    扫描 SIDECAR_PATHS 建立本地元数据索引，重复调用时返回已建立的索引
+    :return: SidecarIndex or None
+    """
+    global sidecar_index
+    if sidecar_index is None and SIDECAR_PATHS:
+        paths = []
+        for path in SIDECAR_PATHS:
+            if os.path.isdir(path):
+                paths.append(path)
             else:
-                logger.info("网络请求超时 url:{}".format(options["url"]))
-                return 0
+                logger.warning(f"<sidecar> 目录不存在：{path}")
+        start = time.monotonic()
+        sidecar_index = SidecarIndex(paths)
+        logger.info(f"<sidecar> <pids> {len(sidecar_index)} <seconds> {round(time.monotonic() - start, 2)}")
+    return sidecar_index
+
+
+# 读取本地已有的作品信息
+def local_illust(pid):
+    """
+    依次读取下载工具保存的本地元数据与缓存
+    :params pid: pixiv插画id
+    :return: (status_code, text) or None (本地没有)
+    """
+    if sidecar_index is not None:
+        resp = sidecar_index.get(pid)
+        if resp is not None:
+            return resp
+    return meta_cache.get(pid) if meta_cache is not None else None
+
+
+# 打开事件记录
+def open_event_log():
+    """
+    根据 EVENT_LOG 打开事件记录，重复调用时返回已打开的记录
+    :return: EventLog or None
+    """
+    global event_log
+    if event_log is None and EVENT_LOG:
+        event_log = EventLog(os.path.join(log_path, EVENT_LOG))
+    return event_log
+
+
+# 启动指标服务
+def start_metrics():
+    """
+    注册缓存、限速器等全局共用对象的指标，按设置启动 /metrics 服务与快照写入
+    :return: (MetricsServer or None, MetricsWriter or None)
+    """
+    if meta_cache is not None:
+        metrics.gauge_func("cache_hits", lambda: meta_cache.hit)
+        metrics.gauge_func("cache_misses", lambda: meta_cache.miss)
+    if sidecar_index is not None:
+        metrics.gauge_func("sidecar_hits", lambda: sidecar_index.hit)
+        metrics.gauge_func("sidecar_invalid", lambda: sidecar_index.invalid)
+    if rate_limiter is not None:
+        metrics.gauge_func("rate_limit", lambda: rate_limiter.state()["rate"])
+        metrics.gauge_func("rate_limit_backoff_seconds", lambda: rate_limiter.state()["backoff"])
+    server = None
+    if METRICS_PORT:
+        try:
+            server = MetricsServer(metrics, METRICS_PORT)
+        except OSError as e:
+            logger.error(f"<metrics> 端口 {METRICS_PORT} 无法使用 Exception:{e}")
+    writer = MetricsWriter(metrics, os.path.join(log_path, METRICS_PATH), METRICS_INTERVAL) if METRICS_PATH else None
+    if server is not None:
+        logger.info(f"<metrics> http://127.0.0.1:{METRICS_PORT}/metrics")
+    return server, writer
+
+
+# 关闭指标服务
+def stop_metrics(server, writer):
+    """
+    写入最后一次快照并关闭 /metrics 服务
+    """
+    if writer is not None:
+        writer.close()
+    if server is not None:
+        server.close()
+
+
+# 关闭事件记录
+def close_event_log():
+    global event_log
+    if event_log is not None:
+        event_log.close()
+        logger.info(f"<event_log> {event_log.path} <events> {event_log.count}")
+        event_log = None
+
+
+# 从pixiv获取作品信息
+def get_illust(pid):
+    """
+    获取pid 的作品信息，优先读取缓存，标签与备注共用同一次请求的结果
+    :params pid: pixiv插画id
+    :return: json_data or None (请求失败)
+    """
+    resp, cached = fetch_illust(pid)
+    if resp is None and OFFLINE:
+        return None
+    return parse_illust(pid, resp, cached)
+
+
+# 获取作品信息的原始返回内容
+def fetch_illust(pid):
+    """
+    获取pid 的原始返回内容，优先读取缓存
+    :params pid: pixiv插画id
+    :return: (resp, cached) resp 为 (status_code, text) or None (请求失败)，cached 为是否来自缓存
+    """
+    cached = local_illust(pid)
+    if cached is not None:
+        return cached, True
+    elif OFFLINE:
+        metrics.inc("illust_errors_total", reason="offline")
+        if event_log is not None:
+            event_log.write("offline", pid=pid)
+        if not QUIET:
+            logger.warning(f"Warning: pid:{pid} 缓存与本地元数据中没有该作品")
+        return None, False
+    return fetch_url(f"{temp_url}{pid}"), False
+
+
+# 获取接口的原始返回内容
+def fetch_url(url):
+    """
+    :params url: 接口地址
+    :return: (status_code, text) or None (请求失败)
+    """
+    resp = baseRequest(
+        options={"url": url}
+    )
+    return (resp.status_code, resp.text) if resp != 0 else None
+
+
+# 解析作品信息
+def parse_illust(pid, resp, cached=False):
+    """
+    解析 /ajax/illust 的返回内容，并写入缓存
+    :params pid: pixiv插画id
+    :params resp: (status_code, text) or None (请求失败)
+    :params cached: resp 是否来自缓存
+    :return: json_data or None (请求失败)
+    """
+    json_data = load_illust(resp)
+    if json_data is not None:
+        check_illust(pid, resp, cached, json_data["error"], json_data.get("message"))
+    else:
+        check_illust(pid, resp, cached)
+    return json_data
+
+
+# 检查作品信息
+def check_illust(pid, resp, cached=False, error=False, message=None):
+    """
+    记录请求失败与错误信息，并将正常内容与404写入缓存
+    :params pid: pixiv插画id
+    :params resp: (status_code, text) or None (请求失败)
+    :params cached: resp 是否来自缓存
+    :params error: 返回内容中的 error 字段
+    :params message: 返回内容中的错误信息
+    """
+    if resp is None:
+        metrics.inc("illust_errors_total", reason="fetch")
+        if event_log is not None:
+            event_log.write("fetch_failed", pid=pid)
+        if not QUIET:
+            logger.warning("Warning:{}".format(pid + ' 获取信息异常'))
+            logger.warning(f"pid:{pid}  resp:0")
+            logger.warning("如果resp=0 大概率是请求过于频繁，可多尝试几次")
+        return
+    status_code, text = resp
+
+    if status_code == 404:
+        metrics.inc("illust_errors_total", reason="404")
+        if event_log is not None:
+            event_log.write("404", pid=pid)
+        if not QUIET:
+            logger.warning("Warning:{}".format(pid + ' Error:404'))
+            logger.warning(f"Warning: pid:{pid}  Massage:{message}")
+    elif error:
+        metrics.inc("illust_errors_total", reason="error")
+        if event_log is not None:
+            event_log.write("error", pid=pid, message=message)
+        if not QUIET:
+            logger.warning("Warning:{}".format(pid + str(message)))
+        return
+    # 只缓存正常内容与404
+    if not cached and meta_cache is not None:
+        meta_cache.put(pid, status_code, text)
 
 
 # 从pixiv获取标签
@@ -157,104 +482,17 @@ def get_tags(pid):
     :params pid: pixiv插画id
     :return: [tag1,tag2...] or []
     """
-    resp = baseRequest(
-        options={"url": f"{temp_url}{pid}"}
-    )
-    if resp == 0:
-        logger.warning("Warning:{}".format(pid + ' 获取信息异常'))
-        logger.warning(f"pid:{pid}  resp:{resp}")
-        logger.warning("如果resp=0 大概率是请求过于频繁，可多尝试几次")
-        return []
-    elif resp.status_code == 404:
-        json_data = json.loads(resp.text)
-        logger.warning("Warning:{}".format(pid + ' Error:404'))
-        logger.warning(f"Warning: pid:{pid}  Massage:{json_data['message']}")
-        return ['Error:404']
-
-    json_data = json.loads(resp.text)
-
-    if not json_data["error"]:
-        tags = json_data["body"]["tags"]["tags"]
-        # 加入画师名称
-        artist = json_data["body"]["userName"]
-        if artist.rfind('@') != -1 and 2 <= artist.rfind('@') <= len(artist) - 3:
-            artist = artist[0:artist.rfind('@')]
-        elif artist.rfind('＠') != -1 and 2 <= artist.rfind('＠') <= len(artist) - 3:
-            artist = artist[0:artist.rfind('＠')]
-        else:
-            artist = artist
-        # 为方便添加父标签，Artist 仍会处理成 ‘Artist:ID’ 形式，将在处理完毕时统一去除 ‘Artist:’
-        tag_list = ["Artist:" + artist]
-
-        for i in tags:
-            if "translation" in i.keys():
-                tag_list.append(i["translation"]["en"])
-            tag_list.append(i["tag"])
-        tag_list = list(set(tag_list))
-        tag_list_r = []
-        for i in tag_list:
-            # i = i.replace("'", "''")
-            tag_list_r.append(i)
-        return list(set(tag_list_r))
-    else:
-        logger.warning("Warning:{}".format(pid + json_data["message"]))
-        return []
+    return build_tags(get_illust(pid))
 
 
+# 从pixiv获取备注
 def get_note(pid):
     """
     从pixiv api获取pid illustTitle userName userId illustComment
     :params pid: pixiv插画id
     :return: "illustTitle userName userId  illustComment" or “”
     """
-    resp = baseRequest(
-        options={"url": f"{temp_url}{pid}"}
-    )
-
-    if resp == 0:
-        logger.warning("Warning:{}".format(pid + ' 获取信息异常'))
-        logger.warning(f"pid:{pid}  resp:{resp}")
-        logger.warning("如果resp=0 大概率是请求过于频繁，可多尝试几次")
-        return ""
-    elif resp.status_code == 404:
-        json_data = json.loads(resp.text)
-        logger.warning("Warning:{}".format(pid + ' Error:404'))
-        logger.warning(f"Warning: pid:{pid}  Massage:{json_data['message']}")
-        return "Error:404"
-
-    json_data = json.loads(resp.text)
-    if not json_data["error"]:
-        # 添加标题
-        note = "Title:" + json_data["body"]["illustTitle"] + "\r\n"  # 获取标题
-        # 添加作者
-        artist = json_data["body"]["userName"]
-        if artist.rfind('@') != -1 and 2 <= artist.rfind('@') <= len(artist) - 3:
-            artist = artist[0:artist.rfind('@')]
-        else:
-            artist = artist
-        note += "Artist:" + artist + "\r\n"
-        # 添加UID
-        note += "UID:" + json_data["body"]["userId"] + "\r\n"
-
-        # 添加Bookmark
-        note += "Bookmark:" + str(json_data["body"]["bookmarkCount"]) + "\r\n"
-
-        # 添加描述
-        if json_data["body"]["illustComment"] != "":
-            note += "Comment:\r\n" + json_data["body"]["illustComment"]
-            # 替换描述中的<br /> 为 \n <a href>替换为[url]href[/url]
-            note = re.sub("<br />+", "\r\n", note).replace("<a href=\"", "[url]").replace(
-                "\" target=\"_blank\">", "[/url]\r\n")
-            # 删除描述中其他HTML标签
-            note = re.sub("<(\S*?)[^>]*>.*?|<.*? /> ", "", note)
-            # 删除转跳提示链接
-            note = re.sub("\[url\]/jump.php.*\[/url\]\r\n", "", note)
-        else:
-            note += "No Comment\r\n"
-        note = re.sub("'", "''", note)
-        return note
-    else:
-        return ""
+    return build_note(get_illust(pid))
 
 
 # 处理为pid
@@ -286,65 +524,77 @@ def get_pid(name):
             return pid
 
 
-# 检查标签是否存在
-def check_tag_exist(tag_name, is_v3_db):
+# Artist标签的另一种形式
+def artist_alias(tag_name):
     """
-   检查标签是否存在
-   :params tag_name: 标签名
-   :parma is_v3_db: 是否为3.0版本的新数据库
-   :return: bf_tag.id or False
-   """
-    # 针对Artist标签，测试 Artist:ID 和 ID 两种形式
-    if is_v3_db and "Artist:" in tag_name:
-        try:
-            index = tag_name_list.index(tag_name[7:])
-            return tag_id_list[index]
-        except Exception as e:
-            None
-    try:
-        index = tag_name_list.index(tag_name)
-        return tag_id_list[index]
-    except Exception as e:
-        return False
-    return False
+    V2版数据库中 Artist:ID 标签会被修改为 ID，查找标签时两种形式都需要测试
+    :param tag_name: 标签名
+    :return: ID or None
+    """
+    if "Artist:" in tag_name:
+        return tag_name[7:]
+    return None
 
 
-# 检查文件是否已经有标签
-def check_file_tag_exist(file_id):
+# 转换为写入的标签
+def tag_rows(tag_list, artist_id=None):
     """
-   检查文件是否已经有标签
-   :params file_id: 文件id bf_file.id
-   :return: True or False
-   """
-    try:
-        tag_join_file_file_id_list.index(file_id)
-        return True
-    except Exception as e:
-        return False
+    将标签列表转换为写入数据库的 (标签名, 父标签id)，标签id在写入时才分配
+    V2版数据库(artist_id 不为 None)中 Artist:ID 标签直接以 ID 写入，并作为Artist标签的子标签
+    :param tag_list: 标签列表
+    :param artist_id: Artist.id，旧版数据库为 None
+    :return: [(name, pid or None), ...]
+    """
+    if artist_id is None:
+        return [(i, None) for i in tag_list]
+    rows = []
+    for i in tag_list:
+        artist = artist_alias(i)
+        rows.append((artist, artist_id) if artist is not None else (i, None))
+    return rows
 
 
-# 检测文件是否已有备注
-def check_note_exist(file_id):
+# 按pid分组文件
+def group_by_pid(bf_file):
     """
-  检查文件是否已经有备注
-  :params file_id: 文件id bf_file.id
-  :return: True or False
-  """
-    try:
-        id = note_file_id_list.index(file_id)
-        if note_note_list[id] is not None:
-            return True
+    将文件按pid分组，多P作品 (114514_p0.png 114514_p1.png ...) 只需请求一次
+    :param bf_file: bf_file["id","name"]
+    :return: {pid: [bf_file, ...]} , [无法识别的bf_file, ...]
+    """
+    pid_group = {}
+    un_file = []
+    for i in bf_file:
+        pid = get_pid(i["name"])
+        if pid:
+            pid_group.setdefault(pid, []).append(i)
         else:
-            return False
-    except Exception as e:
-        return False
+            un_file.append(i)
+    return pid_group, un_file
+
+
+# 分块
+def chunks(items, size):
+    """
+    将列表按 size 分块
+    :param items: 列表
+    :param size: 每块的大小
+    :return: 生成器 [item, ...]
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
 
 class db_tool:
 
-    def __init__(self):
+    def __init__(self, path=None):
+        """
+        :param path: 数据库路径，None 为 DB_PATH
+        """
+        self.path = path or DB_PATH
         self.WRITING_DB = 0
-        if os.path.isfile(DB_PATH):
+        # 导入会话的连接
+        self.session_conn = None
+        if os.path.isfile(self.path):
             if self.connect_db():
                 return
             else:
@@ -352,14 +602,14 @@ class db_tool:
                 exit()
         else:
             logger.error("<DB_PATH> 未找到数据库,请检查数据库路径")
-            logger.error("当前数据库路径为：" + DB_PATH)
+            logger.error("当前数据库路径为：" + self.path)
             exit()
 
     # 链接数据库
-    def connect_db(self):
+    def connect_db(self, check_same_thread=True):
         if not self.WRITING_DB:
             try:
-                conn = sqlite3.connect(DB_PATH)
+                conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, check_same_thread=check_same_thread)
                 conn.row_factory = sqlite3.Row
                 return conn
             except Exception as e:
@@ -373,6 +623,59 @@ class db_tool:
         except Exception as e:
             time.sleep(0.3)
 
+    # 开始导入会话
+    def open_session(self):
+        """
+        打开导入会话的长期连接，按 SESSION_* 设置日志模式、同步模式与页缓存
+        :return: 会话连接
+        """
+        if self.session_conn is not None:
+            return self.session_conn
+        # 会话连接由写入线程使用
+        conn = self.connect_db(check_same_thread=False)
+        # 手动管理事务
+        conn.isolation_level = None
+        if SESSION_JOURNAL_MODE:
+            try:
+                mode = conn.execute(f"PRAGMA journal_mode={SESSION_JOURNAL_MODE}").fetchone()[0]
+            except sqlite3.OperationalError as e:
+                mode = e
+            if str(mode).lower() != SESSION_JOURNAL_MODE.lower():
+                logger.warning(f"<session> 无法设置 journal_mode={SESSION_JOURNAL_MODE}：{mode}")
+        # synchronous 与 cache_size 只对当前连接有效，连接关闭后即恢复
+        if SESSION_SYNCHRONOUS:
+            conn.execute(f"PRAGMA synchronous={SESSION_SYNCHRONOUS}")
+        if SESSION_CACHE_SIZE:
+            conn.execute(f"PRAGMA cache_size={int(SESSION_CACHE_SIZE)}")
+        self.session_conn = conn
+        logger.info(f"<session> <journal_mode> {conn.execute('PRAGMA journal_mode').fetchone()[0]} "
+                    f"<synchronous> {conn.execute('PRAGMA synchronous').fetchone()[0]} "
+                    f"<cache_size> {conn.execute('PRAGMA cache_size').fetchone()[0]}")
+        return conn
+
+    # 结束导入会话
+    def close_session(self):
+        """
+        将 WAL 中的内容写回数据库，恢复为 BILLFISH_JOURNAL_MODE 并关闭会话连接
+        恢复日志模式需要没有其他连接，Billfish 正在使用数据库时会失败，可下次运行时再恢复
+        """
+        conn = self.session_conn
+        if conn is None:
+            return
+        self.session_conn = None
+        try:
+            mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+            if BILLFISH_JOURNAL_MODE and mode.lower() != BILLFISH_JOURNAL_MODE.lower():
+                if mode.lower() == "wal":
+                    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                mode = conn.execute(f"PRAGMA journal_mode={BILLFISH_JOURNAL_MODE}").fetchone()[0]
+                if mode.lower() != BILLFISH_JOURNAL_MODE.lower():
+                    logger.warning(f"<session> 未能恢复 journal_mode={BILLFISH_JOURNAL_MODE}，当前为 {mode}")
+        except Exception as e:
+            logger.error("<session> Exception:{}".format(e))
+        finally:
+            self.close_db(conn)
+
     # 识别数据库版本
     def is_db_ver_3(self):
         """
@@ -394,38 +697,161 @@ class db_tool:
             else:
                 return False
 
-    # 从数据库获取文件名
-    def get_file_name(self):
+    # 只读查询
+    def query(self, sql, params=(), conn=None):
         """
-        从数据库获取文件名 bf_file.name
-        :return: bf_file["id","name"] or None
+        执行只读查询，数据库被占用时等待后重试
+        :param sql: sql语句
+        :param params: 参数
+        :param conn: 使用已有的连接，None 为每次新建连接
+        :return: [sqlite3.Row, ...]
         """
-        conn = self.connect_db()
-        if conn:
-            cursor = conn.cursor()
-            try:
-                if END_FILE_NUM == 0:
-                    count = cursor.execute("select count(*) from bf_file").fetchone()
-                    count = count[0]
-                    row = cursor.execute(
-                        "SELECT id , name FROM bf_file limit ?,?", (str(START_FILE_NUM), str(count))).fetchall()
-                else:
-                    row = cursor.execute("SELECT id , name FROM bf_file limit ?,?", (str(START_FILE_NUM), str(
-                        END_FILE_NUM))).fetchall()
+        while True:
+            _conn = conn or self.connect_db()
+            if _conn:
+                try:
+                    return _conn.execute(sql, params).fetchall()
+                except Exception as e:
+                    logger.error("Exception:{}".format(e))
+                finally:
+                    if conn is None:
+                        self.close_db(_conn)
+            time.sleep(0.3)
+
+    # 按文件id批量查询
+    def query_in(self, sql, file_ids):
+        """
+        将文件id分批填入 sql 中的 {} ，避免超出sqlite的参数数量限制
+        :param sql: 含有 "IN ({})" 的sql语句
+        :param file_ids: 文件id列表
+        :return: [sqlite3.Row, ...]
+        """
+        row = []
+        for part in chunks(list(file_ids), 500):
+            row += self.query(sql.format(",".join("?" * len(part))), part)
+        return row
+
+    # 文件id范围
+    def file_id_range(self, conn):
+        """
+        将 START_FILE_NUM END_FILE_NUM 换算为 bf_file.id 的范围
+        :param conn: 数据库连接
+        :return: (lo, hi) 处理 lo < id <= hi 的文件
+        """
+        lo, hi = -1, 2 ** 63 - 1
+        if START_FILE_NUM:
+            row = self.query("SELECT id FROM bf_file ORDER BY id LIMIT 1 OFFSET ?", (START_FILE_NUM - 1,), conn)
+            if not row:
+                return hi, hi
+            lo = row[0]["id"]
+        if END_FILE_NUM:
+            row = self.query("SELECT id FROM bf_file ORDER BY id LIMIT 1 OFFSET ?",
+                             (START_FILE_NUM + END_FILE_NUM - 1,), conn)
+            if row:
+                hi = row[0]["id"]
+        return lo, hi
 
+    # 可按file_id查询的标签关联表
+    def tagged_table(self, conn):
+        """
+        bf_tag_join_file 上有以 file_id 开头的索引时直接使用，
+        否则在该连接上建立临时表 tagged_file，只扫描一次 bf_tag_join_file
+        :param conn: 数据库连接，临时表只在该连接上可见
+        :return: 表名
+        """
+        for index in self.query("PRAGMA index_list(bf_tag_join_file)", (), conn):
+            column = self.query("PRAGMA index_info('{}')".format(index["name"]), (), conn)
+            if column and column[0]["name"] == "file_id":
+                return "bf_tag_join_file"
+        while True:
+            try:
+                conn.execute("CREATE TEMP TABLE IF NOT EXISTS tagged_file (file_id INTEGER PRIMARY KEY)")
+                conn.execute("INSERT OR IGNORE INTO tagged_file SELECT file_id FROM bf_tag_join_file")
+                conn.commit()
+                return "tagged_file"
             except Exception as e:
                 logger.error("Exception:{}".format(e))
-                return self.get_file_name()
+                conn.rollback()
+                time.sleep(0.3)
+
+    # 读取文件的sql
+    def file_sql(self, conn):
+        """
+        PENDING_QUERY 模式下用 NOT EXISTS 只选出缺少标签/备注的文件，
+        并附带 has_tag has_note 两列，之后不必再逐块查询
+        :param conn: 数据库连接
+        :return: 参数为 (lo, hi) 的sql语句
+        """
+        if not (SKIP and PENDING_QUERY):
+            return "SELECT id , name FROM bf_file WHERE id > ? AND id <= ? ORDER BY id"
+        has_tag = "EXISTS (SELECT 1 FROM {} t WHERE t.file_id = f.id)".format(
+            self.tagged_table(conn)) if WRITE_TAG else "1"
+        has_note = ("EXISTS (SELECT 1 FROM bf_material_userdata u WHERE u.file_id = f.id AND u.note IS NOT NULL)"
+                    if WRITE_NOTE else "1")
+        return ("SELECT id , name , has_tag , has_note FROM ("
+                "SELECT f.id , f.name , {} AS has_tag , {} AS has_note FROM bf_file f WHERE f.id > ? AND f.id <= ?"
+                ") WHERE NOT has_tag OR NOT has_note ORDER BY id").format(has_tag, has_note)
+
+    # 统计需要处理的文件数
+    def count_file(self):
+        """
+        统计 START_FILE_NUM END_FILE_NUM 范围内(PENDING_QUERY 模式下仅缺少内容)的文件数
+        :return: 文件数
+        """
+        conn = self.connect_db()
+        try:
+            return self.query("SELECT count(*) FROM ({})".format(self.file_sql(conn)),
+                              self.file_id_range(conn), conn)[0][0]
+        finally:
             self.close_db(conn)
-            if row is not None:
-                return row
-            else:
-                return None
-        else:
-            # logger.warning(f"Connect db failed... Try again")
+
+    # 从数据库分块获取文件名
+    def iter_file_name(self, id_range=None, chunk=None):
+        """
+        按 bf_file.id 顺序分块读取文件名 bf_file.name，每块 FILE_CHUNK 个文件
+        之后按 id > 上一块最后的id 读取，全程使用同一个连接
+        :param id_range: (lo, hi) 读取 lo < id <= hi 的文件，None 为按 START_FILE_NUM END_FILE_NUM
+        :param chunk: 每块的文件数，None 为 FILE_CHUNK
+        :return: 生成器 [bf_file["id","name"], ...]
+        """
+        conn = self.connect_db()
+        try:
+            last_id, hi = id_range or self.file_id_range(conn)
+            sql = self.file_sql(conn) + " LIMIT ?"
+            while True:
+                row = self.query(sql, (last_id, hi, chunk or FILE_CHUNK), conn)
+                if not row:
+                    return
+                yield row
+                last_id = row[-1]["id"]
+        finally:
             self.close_db(conn)
-            time.sleep(0.3)
-            return self.get_file_name()
+
+    # 最大的文件id
+    def max_file_id(self, conn=None):
+        """
+        :param conn: 使用已有的连接
+        :return: max(bf_file.id) or 0
+        """
+        return self.query("SELECT max(id) FROM bf_file", (), conn)[0][0] or 0
+
+    # 查询已有标签的文件
+    def get_tag_file_id(self, file_ids):
+        """
+        :param file_ids: 文件id列表
+        :return: {已有标签的文件id, ...}
+        """
+        return {i["file_id"] for i in self.query_in(
+            "SELECT DISTINCT file_id FROM bf_tag_join_file WHERE file_id IN ({})", file_ids)}
+
+    # 查询已有备注的文件
+    def get_note_file_id(self, file_ids):
+        """
+        :param file_ids: 文件id列表
+        :return: {已有备注的文件id, ...}
+        """
+        return {i["file_id"] for i in self.query_in(
+            "SELECT file_id FROM bf_material_userdata WHERE note IS NOT NULL AND file_id IN ({})", file_ids)}
 
     # 从数据库获取标签
     def get_db_tags(self, is_v3_db):
@@ -457,136 +883,62 @@ class db_tool:
             time.sleep(0.3)
             return self.get_db_tags(is_v3_db)
 
-    # 从数据库获取文件标签
-    def get_db_tag_join_file(self):
-        conn = self.connect_db()
-        if conn:
-            cursor = conn.cursor()
-            try:
-                row = cursor.execute("SELECT file_id,tag_id FROM bf_tag_join_file").fetchall()
-            except Exception as e:
-                logger.error("Exception:{}".format(e))
-                return self.get_db_tag_join_file()
-            self.close_db(conn)
-            if row:
-                return row
-            else:
-                return []
-        else:
-            # logger.warning(f"Connect db failed... Try again")
-            self.close_db(conn)
-            time.sleep(0.3)
-            return self.get_db_tag_join_file()
-
-    # 从数据库获取备注
-    def get_db_note(self):
-        conn = self.connect_db()
-        if conn:
-            cursor = conn.cursor()
-            try:
-                row = cursor.execute("SELECT file_id,note FROM bf_material_userdata").fetchall()
-            except Exception as e:
-                logger.error("Exception:{}".format(e))
-                return self.get_db_note()
-            self.close_db(conn)
-            if row:
-                return row
-            else:
-                return []
-        else:
-            self.close_db(conn)
-            time.sleep(0.3)
-            return self.get_db_note()
-
     # 写入标签
-    def write_tag_db(self, prepare_tag, is_v3_db):
+    def write_tag_db(self, conn, tag_index, prepare_tag, is_v3_db):
         """
-        写入标签 bf_tag.id
-                bf_tag.name
-        :param prepare_tag: 缓存的tag
+        取得标签id，写入新标签 bf_tag.id
+                              bf_tag.name
+        索引中没有的标签先按名称在数据库中查找(可能已由Billfish创建)，仍没有时写入并由数据库分配id，
+        需在写入事务中调用，不会与其他程序同时创建的标签冲突
+        不提交，由 db_writer 统一提交
+        :param conn: 数据库连接
+        :param tag_index: TagIndex
+        :param prepare_tag: [(name, pid or None), ...]，pid 为父标签id，旧版数据库忽略
         :parma is_v3_db: 是否为3.0版本的新数据库
+        :return: ({name: id} 本次查找或写入的标签，提交后再加入 tag_index, 新写入的标签数)
         """
-        conn = self.connect_db()
-        if conn and not self.WRITING_DB:
-            cursor = conn.cursor()
-            try:
-                self.WRITING_DB = 1
-                for i in prepare_tag:
-                    if is_v3_db:
-                        cursor.execute("INSERT INTO bf_tag_v2 (id,name) VALUES(?, ?)", (i["id"], i["name"]))
-                    else:
-                        cursor.execute("INSERT INTO bf_tag (id,name) VALUES(?, ?)", (i["id"], i["name"]))
-                conn.commit()
-                self.WRITING_DB = 0
-                self.close_db(conn)
-                return True
-            except Exception as e:
-                self.close_db(conn)
-                self.WRITING_DB = 0
-                logger.info("Exception:{}".format(e))
-                return self.write_tag_db(prepare_tag, is_v3_db)
-        else:
-            time.sleep(0.3)
-            return self.write_tag_db(prepare_tag, is_v3_db)
+        table = "bf_tag_v2" if is_v3_db else "bf_tag"
+        pending = {name: pid for name, pid in prepare_tag if tag_index.get(name) is None}
+        found = {}
+        new_num = 0
+        # name 没有索引，分块一次查询多个标签
+        for names in chunks(list(pending), 500):
+            sql = f"SELECT id, name FROM {table} WHERE name IN ({','.join('?' * len(names))})"
+            for row in conn.execute(sql, names):
+                found.setdefault(row[1], row[0])
+        for name, pid in pending.items():
+            if name in found:
+                continue
+            if is_v3_db:
+                cursor = conn.execute("INSERT INTO bf_tag_v2 (name,pid) VALUES(?, ?)", (name, pid))
+            else:
+                cursor = conn.execute("INSERT INTO bf_tag (name) VALUES(?)", (name,))
+            found[name] = cursor.lastrowid
+            new_num += 1
+        return found, new_num
 
     # 写入文件标签
-    def write_tag_join_file_db(self, prepare_tag_join_file):
+    def write_tag_join_file_db(self, conn, prepare_tag_join_file):
         """
-        写入标签 bf_tag_join_file.file_id
-                bf_tag_join_file.tag_id
-        :param prepare_tag_join_file: 缓存的文件与tag关系
+        批量写入标签 bf_tag_join_file.file_id
+                    bf_tag_join_file.tag_id
+        不提交，由 db_writer 统一提交
+        :param conn: 数据库连接
+        :param prepare_tag_join_file: 缓存的文件与tag关系 [(file_id, tag_id), ...]
         """
-        conn = self.connect_db()
-        # logger.info(f"write_tag_join_file_db"+ str(self.WRITING_DB))
-        if conn and not self.WRITING_DB:
-            cursor = conn.cursor()
-            try:
-                self.WRITING_DB = 1
-                for i in prepare_tag_join_file:
-                    cursor.execute(
-                        "INSERT INTO bf_tag_join_file (file_id,tag_id) VALUES (?,?)", (i["file_id"], i["tag_id"]))
-                conn.commit()
-                self.WRITING_DB = 0
-                self.close_db(conn)
-                return True
-            except Exception as e:
-                self.close_db(conn)
-                self.WRITING_DB = 0
-                logger.info("Exception:{}".format(e))
-                return self.write_tag_join_file_db(prepare_tag_join_file)
-        else:
-            time.sleep(0.3)
-            self.close_db(conn)
-            return self.write_tag_join_file_db(prepare_tag_join_file)
+        conn.executemany("INSERT INTO bf_tag_join_file (file_id,tag_id) VALUES (?,?)", prepare_tag_join_file)
 
     # 写入备注
-    def write_note(self, prepare_note_join_file):
+    def write_note(self, conn, prepare_note_join_file):
         """
-        写入备注 bf_material_userdata.file_id
-                bf_material_userdata.note
-        :param prepare_note_join_file:缓存的文件备注
+        批量写入备注 bf_material_userdata.file_id
+                    bf_material_userdata.note
+        不提交，由 db_writer 统一提交
+        :param conn: 数据库连接
+        :param prepare_note_join_file:缓存的文件备注 [(file_id, note, origin), ...]
         """
-        conn = self.connect_db()
-        # logger.info(f"write_note"+ str(self.WRITING_DB))
-        if conn and not self.WRITING_DB:
-            try:
-                self.WRITING_DB = 1
-                for i in prepare_note_join_file:
-                    conn.cursor().execute("INSERT INTO bf_material_userdata (file_id,note,origin) VALUES (?,?,?)",
-                                          (str(i["file_id"]), i["note"], i["origin"]))
-                conn.commit()
-                self.WRITING_DB = 0
-                self.close_db(conn)
-                return True
-            except Exception as e:
-                self.close_db(conn)
-                self.WRITING_DB = 0
-                logger.info("Exception:{}".format(e))
-                return self.write_note(prepare_note_join_file)
-        else:
-            time.sleep(0.3)
-            self.close_db(conn)
-            return self.write_note(prepare_note_join_file)
+        conn.executemany("INSERT INTO bf_material_userdata (file_id,note,origin) VALUES (?,?,?)",
+                         prepare_note_join_file)
 
     # 获取Artist标签
     def get_artist_id(self):
@@ -613,6 +965,18 @@ class db_tool:
             time.sleep(0.3)
             return self.get_artist_id()
 
+    # 在事务中获取Artist标签
+    def get_artist_id_in(self, conn):
+        """
+        在已开始的事务中获取Artist父标签的ID，不存在时创建，不提交
+        :param conn: 已开始事务的连接
+        :return Artist.id
+        """
+        row = conn.execute("SELECT id FROM bf_tag_v2 WHERE name='Artist'").fetchone()
+        if row is not None:
+            return row[0]
+        return conn.execute("INSERT INTO bf_tag_v2 (name) VALUES ('Artist')").lastrowid
+
     # 创建Artist标签
     def create_artist_tag(self):
         """
@@ -665,32 +1029,260 @@ class db_tool:
             time.sleep(0.3)
             return self.get_artists_id()
 
-    # 更新artist tag
-    def update_artist_tag(self, artistlist):
+    # 整理旧的作者标签
+    def migrate_artist_tags(self, artist_id, conn=None):
         """
-        针对3.0版本数据库，将作者tag从Artist:id修改为 id 并加入Artist父标签下
-        :param artistlist: 作者tag表
+        针对3.0版本数据库，用一条语句将所有未加入Artist的 Artist:ID 标签修改为 ID 并加入Artist父标签下
+        :param artist_id: Artist.id
+        :param conn: 已开始事务的连接，在该事务中修改且不提交，None为单独建立连接并提交
+        :return: 修改的标签数
         """
-        conn = self.connect_db()
-        if conn and not self.WRITING_DB:
-            cursor = conn.cursor()
+        if conn is not None:
+            return conn.execute(
+                "UPDATE bf_tag_v2 SET name = substr(name, 8) , pid = ? "
+                "WHERE name LIKE 'Artist:%' AND (pid IS NULL OR pid = 0)", (artist_id,)).rowcount
+        while True:
+            conn = self.connect_db()
+            if conn:
+                try:
+                    with conn:
+                        return conn.execute(
+                            "UPDATE bf_tag_v2 SET name = substr(name, 8) , pid = ? "
+                            "WHERE name LIKE 'Artist:%' AND (pid IS NULL OR pid = 0)", (artist_id,)).rowcount
+                except Exception as e:
+                    logger.info("Exception:{}".format(e))
+                finally:
+                    self.close_db(conn)
+            time.sleep(0.3)
+
+
+class db_writer:
+    """
+    唯一的写入线程，持有一个长期连接，从有界队列中取出 标签/文件标签/备注 并按组提交
+    """
+
+    def __init__(self, db_tool, is_v3_db, tag_index, journal=None):
+        """
+        :param db_tool: db_tool
+        :parma is_v3_db: 是否为3.0版本的新数据库
+        :param tag_index: TagIndex，新标签提交后加入
+        :param journal: ProgressJournal，提交成功后记录进度，None为不记录
+        """
+        self.db_tool = db_tool
+        self.is_v3_db = is_v3_db
+        self.tag_index = tag_index
+        self.journal = journal
+        self.q = queue.Queue(WRITE_QUEUE_SIZE)
+        # 提交次数与已提交条数
+        self.commit_count = 0
+        self.row_count = 0
+        # 每次提交的耗时(秒)
+        self.commit_times = []
+        # 中断后不再等待被占用的数据库
+        self.cancel_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="db_writer")
+        self.thread.start()
+
+    def put(self, kind, rows):
+        """
+        将一批内容放入写入队列
+        :param kind: "join" [(file_id, name, pid), ...] 标签id在提交时取得，pid 为新标签的父标签id
+                     "note" [(file_id, note, origin), ...]
+                     "pid" [("tag" or "note", pid), ...] 已全部放入队列的作品，仅用于记录进度
+        :param rows: 内容列表
+        """
+        if rows:
+            self.q.put((kind, rows))
+
+    def close(self, cancelled=False):
+        """
+        写入队列中剩余的内容并结束写入线程
+        :param cancelled: 程序是否被中断，中断时数据库被占用的批次不再重试，直接放弃(不记录进度)
+        """
+        if cancelled:
+            self.cancel_event.set()
+        self.q.put(None)
+        self.thread.join()
+
+    def run(self):
+        # 导入会话中使用会话连接，否则单独建立连接
+        session = self.db_tool.session_conn
+        conn = session or self.db_tool.connect_db()
+        # 手动管理事务，每次提交使用一个 BEGIN IMMEDIATE 事务
+        conn.isolation_level = None
+        prepare = {"join": [], "note": [], "pid": []}
+        num = 0
+        last_commit = time.time()
+        closing = False
+        while not closing:
             try:
-                self.WRITING_DB = 1
-                for i in artistlist:
-                    cursor.execute(
-                        "UPDATE bf_tag_v2 SET name = ? , pid = ?  WHERE id = ? ", (i["name"], i["pid"], i["id"]))
-                conn.commit()
-                self.WRITING_DB = 0
-                self.close_db(conn)
-                return True
+                event = self.q.get(timeout=max(0.0, last_commit + COMMIT_INTERVAL - time.time()))
+            except queue.Empty:
+                event = False
+            if event is None:
+                closing = True
+            elif event:
+                prepare[event[0]].extend(event[1])
+                num += len(event[1])
+            if num and (num >= COMMIT_NUM or closing or time.time() - last_commit >= COMMIT_INTERVAL):
+                self.commit(conn, prepare)
+                for i in prepare.values():
+                    i.clear()
+                num = 0
+            if not num:
+                last_commit = time.time()
+        if session is None:
+            self.db_tool.close_db(conn)
+
+    def commit(self, conn, prepare):
+        """
+        在同一个事务中写入并提交，数据库被占用时回滚并重试，直至成功或程序被中断
+        其他错误(如约束冲突、表结构不符)重试也不会成功，回滚后放弃这一批，不记录进度
+        :param conn: 数据库连接
+        :param prepare: {"join": [...], "note": [...], "pid": [...]}
+        :return: 是否提交成功
+        """
+        start = time.monotonic()
+        # 数据库被占用(如Billfish正在写入)时，重试间隔逐次翻倍，最长30秒
+        delay = 0.3
+        while True:
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                # 新标签在事务中写入并取得id，提交前其他连接不能写入
+                found, new_num = self.db_tool.write_tag_db(
+                    conn, self.tag_index, dict((i[1], i[2]) for i in prepare["join"]).items(), self.is_v3_db)
+                self.db_tool.write_tag_join_file_db(
+                    conn, [(i[0], found.get(i[1]) or self.tag_index.get(i[1])) for i in prepare["join"]])
+                self.db_tool.write_note(conn, prepare["note"])
+                conn.execute("COMMIT")
+                self.tag_index.update(found)
+                break
             except Exception as e:
-                self.close_db(conn)
-                self.WRITING_DB = 0
-                logger.info("Exception:{}".format(e))
-                return self.update_artist_tag(artistlist)
-        else:
-            time.sleep(0.3)
-            return self.update_artist_tag(artistlist)
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                busy = isinstance(e, sqlite3.OperationalError) and ("locked" in str(e) or "busy" in str(e))
+                if busy and not self.cancel_event.is_set():
+                    logger.info("Exception:{} 将在 {}s 后重试".format(e, delay))
+                    self.cancel_event.wait(delay)
+                    delay = min(delay * 2, 30)
+                    continue
+                rows = len(prepare["join"]) + len(prepare["note"])
+                logger.error("<db_writer> 写入失败，放弃这一批 <rows> {} Exception:{!r}".format(rows, e))
+                metrics.inc("commit_errors_total")
+                if event_log is not None:
+                    event_log.write("commit_failed", rows=rows, pids=[i[1] for i in prepare["pid"]],
+                                    message=str(e))
+                return False
+        self.commit_times.append(time.monotonic() - start)
+        metrics.observe("commit_seconds", self.commit_times[-1])
+        metrics.observe("commit_rows", new_num + len(prepare["join"]) + len(prepare["note"]),
+                        (10, 100, 500, 1000, 2500, 5000, 10000, 50000))
+        # 内容提交后再记录进度，中断时最多重复写入最后一批
+        if self.journal is not None:
+            self.journal.mark("tag", {i[0] for i in prepare["join"]}, [i[1] for i in prepare["pid"] if i[0] == "tag"])
+            self.journal.mark("note", [i[0] for i in prepare["note"]], [i[1] for i in prepare["pid"] if i[0] == "note"])
+        self.commit_count += 1
+        self.row_count += new_num + len(prepare["join"]) + len(prepare["note"])
+        logger.debug(f"<db_writer> <commit> {self.commit_count} <rows> {self.row_count}")
+        return True
+
+
+class parse_stage:
+    """
+    解析阶段，将作品的原始返回内容分批交给解析进程生成标签与备注，完成后交给回调函数写入
+    """
+
+    def __init__(self, processes, batch_size, callback):
+        """
+        :param processes: 解析进程数
+        :param batch_size: 每批的作品数
+        :param callback: 回调函数 callback(arg, tag_list, note)
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        self.pool = ProcessPoolExecutor(processes)
+        self.batch_size = batch_size
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.batch = []
+        # 限制同时解析的批数，解析跟不上时获取线程会等待
+        self.slots = threading.Semaphore(processes * 2)
+        # 已提交的批数
+        self.batch_count = 0
+
+    def put(self, arg, resp, cached, write_tag, write_note):
+        """
+        放入一个作品，积累够一批时交给解析进程
+        :param arg: 回调函数的参数
+        :param resp: (status_code, text) or None (请求失败)
+        :param cached: resp 是否来自缓存
+        :param write_tag: 是否需要生成标签
+        :param write_note: 是否需要生成备注
+        """
+        with self.lock:
+            self.batch.append((arg, resp, cached, write_tag, write_note))
+            if len(self.batch) < self.batch_size:
+                return
+            batch, self.batch = self.batch, []
+        self.slots.acquire()
+        self.submit(batch)
+
+    def flush(self):
+        """
+        将不足一批的作品交给解析进程
+        """
+        with self.lock:
+            batch, self.batch = self.batch, []
+        if batch:
+            self.slots.acquire()
+            self.submit(batch)
+
+    def submit(self, batch):
+        self.batch_count += 1
+        try:
+            future = self.pool.submit(parse_batch, [(i[1], i[3], i[4]) for i in batch])
+        except Exception as e:
+            # 解析进程已不可用(如 BrokenProcessPool)，这一批按获取失败处理
+            logger.error("<parse_stage> Exception:{!r}".format(e))
+            self.done(batch, None)
+            return
+        future.add_done_callback(lambda f: self.done(batch, f))
+
+    def done(self, batch, future):
+        """
+        一批解析完成，检查返回内容并逐个回调，每个作品都会回调一次
+        :param future: 解析进程的 Future，None 为未能提交
+        """
+        try:
+            result = None
+            if future is not None:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error("<parse_stage> Exception:{!r}".format(e))
+            if result is None or len(result) != len(batch):
+                result = [(None, None, True, None)] * len(batch)
+            for (arg, resp, cached, _, _), (tag_list, note, error, message) in zip(batch, result):
+                # 解析出错时按获取失败处理
+                try:
+                    if tag_list is not None:
+                        check_illust(arg[0], resp, cached, error, message)
+                    elif message is not None:
+                        logger.error("<parse_stage> <pid> {} Exception:{}".format(arg[0], message))
+                except Exception as e:
+                    logger.error("<parse_stage> <pid> {} Exception:{!r}".format(arg[0], e))
+                try:
+                    self.callback(arg, tag_list or [], note or "")
+                except Exception as e:
+                    logger.error("<parse_stage> <pid> {} Exception:{!r}".format(arg[0], e))
+        finally:
+            self.slots.release()
+
+    def close(self):
+        """
+        提交剩余的作品并等待全部解析完成
+        """
+        self.flush()
+        self.pool.shutdown(wait=True)
 
 
 class pixiv2Billfish:
@@ -715,14 +1307,22 @@ class pixiv2Billfish:
     # 备注已写入
     note_pass_count = 0
 
-    def __init__(self):
+    def __init__(self, db_path=None):
+        """
+        :param db_path: 数据库路径，None 为 DB_PATH
+        """
+        self.db_path = db_path or DB_PATH
         self.task_num = 0
-        self.WRITING_TAG = 0
-        self.WRITING = 0
         self.done_num = 0
-        self.db_tool = db_tool()
-
-        logger.debug(f"DB_PATH={DB_PATH}")
+        # 保护计数与完成状态，计数会在多个线程中修改
+        self.count_lock = threading.Lock()
+        # 所有任务完成或程序被中断时触发
+        self.done_event = threading.Event()
+        # 程序被 Ctrl+C 中断
+        self.cancelled = False
+        self.db_tool = db_tool(self.db_path)
+
+        logger.debug(f"DB_PATH={self.db_path}")
         logger.debug(f"useProxies ={useProxies}")
         if useProxies:
             logger.debug(f"proxies ={proxies}")
@@ -731,8 +1331,19 @@ class pixiv2Billfish:
         logger.debug(f"START_FILE_NUM={START_FILE_NUM}")
         logger.debug(f"END_FILE_NUM={END_FILE_NUM}")
         logger.debug(f"SKIP={SKIP}")
-        logger.debug(f"TAG_Thread={TAG_Thread}")
-        logger.debug(f"NOTE_Thread={NOTE_Thread}")
+        logger.debug(f"PENDING_QUERY={PENDING_QUERY}")
+        logger.debug(f"RESUME={RESUME}")
+        logger.debug(f"FETCH_ENGINE={FETCH_ENGINE}")
+        logger.debug(f"FETCH_Thread={FETCH_Thread}")
+        logger.debug(f"ASYNC_LIMIT={ASYNC_LIMIT}")
+        logger.debug(f"RATE_LIMIT={RATE_LIMIT} RATE_LIMIT_MIN={RATE_LIMIT_MIN} RATE_LIMIT_MAX={RATE_LIMIT_MAX}")
+        logger.debug(f"CACHE_PATH={CACHE_PATH}")
+        logger.debug(f"CACHE_TTL={CACHE_TTL}")
+        logger.debug(f"OFFLINE={OFFLINE}")
+        logger.debug(f"METRICS_PORT={METRICS_PORT} METRICS_PATH={METRICS_PATH}")
+        logger.debug(f"QUIET={QUIET} EVENT_LOG={EVENT_LOG}")
+        logger.debug(f"IMPORT_SESSION={IMPORT_SESSION} SESSION_JOURNAL_MODE={SESSION_JOURNAL_MODE} "
+                     f"SESSION_SYNCHRONOUS={SESSION_SYNCHRONOUS} SESSION_CACHE_SIZE={SESSION_CACHE_SIZE}")
 
         if not (WRITE_TAG or WRITE_NOTE):
             logger.error("设置不正确，请检查WRITE_TAG WRITE_NOTE设置！")
@@ -741,321 +1352,1027 @@ class pixiv2Billfish:
             exit(0)
 
         self.is_v3_db = self.db_tool.is_db_ver_3()
+        open_cache()
+        open_sidecar()
+        open_rate_limiter()
+        open_event_log()
+
+        # V2版数据库启动时确定Artist父标签，作者标签创建时即加入其下，旧的 Artist:ID 标签在此一并整理
+        # PLAN = "write" 时不修改数据库，由 apply_plan 处理
+        self.artist_id = None
+        if self.is_v3_db and PLAN != "write":
+            self.artist_id = self.db_tool.get_artist_id()
+            migrated = self.db_tool.migrate_artist_tags(self.artist_id)
+            if migrated:
+                logger.info(f"<migrate_artist_tags> {migrated}")
+
+        tag_row = self.db_tool.get_db_tags(self.is_v3_db)
+        self.task_len = self.db_tool.count_file()
+
+        # 标签名 -> bf_tag.id，新标签的id由其统一分配
+        self.tag_index = TagIndex((i["id"], i["name"]) for i in tag_row)
+        # 当前块中已有标签/备注的文件id，由 iter_group_task 分块查询
+        self.tag_file_index = set()
+        self.note_file_index = set()
+        # 当前块中上次中断前已完成的文件id
+        self.tag_done_index = set()
+        self.note_done_index = set()
+
+        self.journal = None
+        # PLAN = "write" 时不修改数据库，也不记录进度
+        self.plan = None
+        if RESUME and PLAN != "write":
+            self.journal = ProgressJournal(os.path.join(log_path, PROGRESS_PATH), os.path.abspath(self.db_path))
+            if self.journal.pid_count("tag") or self.journal.pid_count("note"):
+                logger.info(f"<resume> <tag pids> {self.journal.pid_count('tag')} "
+                            f"<note pids> {self.journal.pid_count('note')}")
+        # 所有任务是否已放入线程池
+        self.dispatch_done = False
+        # 已读取的文件数
+        self.file_num = 0
+        # PARSE_PROCESS 时的解析阶段
+        self.parse_stage = None
+        # FETCH_ENGINE = "batch" 时的批量获取
+        self.batch_fetcher = None
+        # 监视模式中被 Ctrl+C 中断时触发
+        self.stop_event = threading.Event()
+
+        if not self.task_len:
+            if SKIP and PENDING_QUERY and self.db_tool.query("SELECT 1 FROM bf_file LIMIT 1"):
+                logger.info("<pending> 0 所有文件均已有标签/备注")
+            elif not WATCH:
+                logger.error("数据库为空！")
+        elif SKIP and PENDING_QUERY:
+            logger.info(f"<pending> {self.task_len}")
+
+    def open_writer(self):
+        """
+        创建写入线程，PLAN = "write" 时改为写入计划文件
+        """
+        if PLAN == "write":
+            self.plan = ImportPlan(os.path.join(log_path, PLAN_PATH), os.path.abspath(self.db_path), self.is_v3_db)
+            self.db_writer = None
+        else:
+            if IMPORT_SESSION:
+                self.db_tool.open_session()
+            self.db_writer = db_writer(self.db_tool, self.is_v3_db, self.tag_index, self.journal)
 
-        self.bf_file = self.db_tool.get_file_name()
-        self.tag_row = self.db_tool.get_db_tags(self.is_v3_db)
-        self.tag_file_row = self.db_tool.get_db_tag_join_file()
-        self.note_row = self.db_tool.get_db_note()
-
-        if self.bf_file is None:
-            logger.error("数据库为空！")
-            exit(0)
-
-        for i in self.tag_row:
-            tag_id_list.append(i["id"])
-            tag_name_list.append(i["name"])
-        for i in self.tag_file_row:
-            tag_join_file_file_id_list.append(i["file_id"])
-            tag_join_file_tag_id_list.append(i["tag_id"])
-        for i in self.note_row:
-            note_file_id_list.append(i["file_id"])
-            note_note_list.append(i["note"])
-
-        self.task_len = len(list(self.bf_file))
+    def close_writer(self, cancelled=False):
+        """
+        写入剩余内容并关闭写入线程(或计划文件)，正常结束时清除进度记录
+        :params cancelled: 程序是否被中断
+        """
+        if self.plan is not None:
+            self.close_plan(cancelled)
+        else:
+            logger.info("<TOOLS was closed writing db now...>")
+            self.db_writer.close(cancelled)
+            logger.info(f"<db_writer Success> <commit> {self.db_writer.commit_count} "
+                        f"<rows> {self.db_writer.row_count}")
+        # 正常结束，清除进度记录
+        if self.journal is not None and not cancelled:
+            self.journal.clear()
+        self.db_tool.close_session()
+
+    def log_summary(self):
+        """
+        输出文件与 标签/备注 的统计
+        """
+        logger.info(f"<当前文件总数> {self.tag_count}")
+        logger.info(f"<成功识别文件数> {self.tag__count}")
+        logger.info(f"<无法识别文件数> {self.tag_un_count}")
+        if WRITE_TAG:
+            logger.info(f"<标签写入成功数> {self.tag_success_count}")
+            logger.info(f"<标签跳过数> {self.tag_pass_count}")
+        if WRITE_NOTE:
+            logger.info(f"<备注写入成功数> {self.note_success_count}")
+            logger.info(f"<备注跳过数> {self.note_pass_count}")
 
     def main(self):
-        tag_flag = 0
-        note_flag = 0
-        if self.bf_file is not None:
+        if self.task_len:
+            self.open_writer()
+            if PARSE_PROCESS:
+                self.parse_stage = parse_stage(PARSE_PROCESS, PARSE_BATCH, lambda arg, tag_list, note:
+                                               self.write_result(*arg, tag_list, note))
+            self.open_metrics()
+            if QUIET:
+                # 主线程分发任务时可能长时间等待，进度由单独的线程输出
+                threading.Thread(target=self.progress_task, name="progress", daemon=True).start()
+            # Ctrl+C 时只设置标识，由各处自行停止，再次 Ctrl+C 则直接退出
+            if threading.current_thread() is threading.main_thread():
+                signal.signal(signal.SIGINT, self.on_interrupt)
             try:
-                if WRITE_NOTE:
-                    FOR_TOOL.put(self.thread_task_for, ('note', self.bf_file,), callback)
-                    self.task_num += self.task_len
-                if WRITE_TAG:
-                    FOR_TOOL.put(self.thread_task_for, ('tag', self.bf_file,), callback)
-                    self.task_num += self.task_len
-                while True:
-                    if self.done_num >= self.task_num:
-                        break
-                    else:
-                        time.sleep(10)
-                    # break
+                # 在主线程中分发任务，线程池队列已满时在此等待
+                if FETCH_ENGINE == "async":
+                    self.async_task_for()
+                elif FETCH_ENGINE == "batch":
+                    self.batch_task_for()
+                else:
+                    self.thread_task_for()
+                # 最后一个任务完成时立即返回，期间每10秒输出一次限速状态
+                tick = 0
+                while not self.done_event.wait(1):
+                    # 任务已全部放入后，将不足一批的作品交给解析进程
+                    if self.parse_stage is not None and self.dispatch_done:
+                        self.parse_stage.flush()
+                    tick += 1
+                    if tick % 10 == 0 and rate_limiter is not None:
+                        logger.info(f"<rate_limiter> {rate_limiter.state()}")
             except Exception as e:
                 logger.error("Exception:{}".format(e))
-                FOR_TOOL.close()
-            finally:
-                FOR_TOOL.close()
-
-            while True:
-                logger.info(
-                    f"<free_list> {TAG_TOOL.free_list} <max_num> {TAG_TOOL.max_num} <generate_list> {TAG_TOOL.generate_list}")
-                logger.info(
-                    f"<free_list> {NOTE_TOOL.free_list} <max_num> {NOTE_TOOL.max_num} <generate_list> {NOTE_TOOL.generate_list}")
+                self.cancelled = True
+            if self.cancelled:
+                # 取消尚未开始的任务，已完成的内容仍会写入数据库并记录进度
+                if not FETCH_TOOL.terminate(CANCEL_TIMEOUT):
+                    logger.warning(f"<FETCH_TOOL> {CANCEL_TIMEOUT}s 内未能结束所有任务")
+            else:
                 # 正常关闭线程池
-                if WRITE_NOTE:
-                    if NOTE_TOOL.free_list == [] and NOTE_TOOL.generate_list == []:
-                        NOTE_TOOL.close()
-                        logger.info(f"<当前文件总数> {self.tag_count}")
-                        logger.info(f"<成功识别文件数> {self.tag__count}")
-                        logger.info(f"<无法识别文件数> {self.tag_un_count}")
-                        logger.info(f"<备注写入成功数> {self.note_success_count}")
-                        logger.info(f"<备注跳过数> {self.note_pass_count}")
-                        note_flag = 1
-                else:
-                    note_flag = 1
-                if WRITE_TAG:
-                    if TAG_TOOL.free_list == [] and TAG_TOOL.generate_list == []:
-                        TAG_TOOL.close()
-                        logger.info(f"<当前文件总数> {self.tag_count}")
-                        logger.info(f"<成功识别文件数> {self.tag__count}")
-                        logger.info(f"<无法识别文件数> {self.tag_un_count}")
-                        logger.info(f"<标签写入成功数> {self.tag_success_count}")
-                        logger.info(f"<标签跳过数> {self.tag_pass_count}")
-                        tag_flag = 1
-                else:
-                    tag_flag = 1
-                if tag_flag and note_flag:
-                    t = 0
-                    logger.info("<TOOLS was closed writing db now...>")
-                    while True:
-                        if WRITE_TAG:
-                            if not self.WRITING and prepare_tag is not None:
-                                if self.write_tag_in_db(True):
-                                    logger.info("<write_tag_in_db Success>")
-                                    t += 1
-                            if not self.WRITING and prepare_tag_join_file is not None:
-                                if self.write_tag_join_file_db(True):
-                                    logger.info("<write_tag_join_file_db Success>")
-                                    t += 1
-                        if WRITE_NOTE:
-                            if not self.WRITING:
-                                if self.write_note_join_file_db(True):
-                                    logger.info("<write_note_join_file_db Success>")
-                                    t += 1
-                        if t == WRITE_TAG * 2 + WRITE_NOTE:
-                            break
-                break
-            # 针对新版数据库对作者标签进行修改
-            if self.is_v3_db:
-                logger.info("<update_artist_list...>")
-                new_artistlist = []
-                artistlist = self.db_tool.get_artists_id()
-
-                if artistlist:
-                    artistid = self.db_tool.get_artist_id()
-                    if artistid:
-                        for i in artistlist:
-                            name = i["name"][7:]
-                            new_artistlist.append({'id': str(i["id"]), 'name': str(name), 'pid': str(artistid)})
-                        self.db_tool.update_artist_tag(new_artistlist)
-                logger.info("<update_artist_list Success>")
+                FETCH_TOOL.close()
+            if self.parse_stage is not None:
+                self.parse_stage.close()
+                logger.info(f"<parse_stage> <batch> {self.parse_stage.batch_count}")
+            if self.batch_fetcher is not None:
+                logger.info(f"<batch> <artists> {len(self.batch_fetcher.works)} "
+                            f"<requests> {self.batch_fetcher.batch_count} <works> {self.batch_fetcher.work_count} "
+                            f"<untranslated> {self.batch_fetcher.unknown_count}")
+
+            logger.info(f"<FETCH_TOOL> <max_num> {FETCH_TOOL.max_num} <threads> {len(FETCH_TOOL.generate_list)} "
+                        f"<success> {FETCH_TOOL.success_count} <failed> {FETCH_TOOL.fail_count}")
+            self.log_summary()
+            self.close_writer(self.cancelled)
+            self.close_metrics()
+            close_event_log()
+
+    def open_metrics(self):
+        """
+        注册队列长度等指标，按设置启动 /metrics 服务与快照写入
+        """
+        metrics.gauge_func("files_total", lambda: self.task_len)
+        metrics.gauge_func("files_read", lambda: self.file_num)
+        metrics.gauge_func("tasks_dispatched", lambda: self.task_num)
+        metrics.gauge_func("tasks_done", lambda: self.done_num)
+        metrics.gauge_func("fetch_queue", FETCH_TOOL.q.qsize)
+        if self.db_writer is not None:
+            metrics.gauge_func("write_queue", self.db_writer.q.qsize)
+            metrics.gauge_func("commits", lambda: self.db_writer.commit_count)
+        if self.parse_stage is not None:
+            metrics.gauge_func("parse_batches", lambda: self.parse_stage.batch_count)
+        self.metrics_server, self.metrics_writer = start_metrics()
+
+    def progress_task(self):
+        """
+        QUIET 时每 PROGRESS_INTERVAL 秒输出一次进度，直至所有任务完成
+        """
+        start = time.monotonic()
+        while not self.done_event.wait(PROGRESS_INTERVAL):
+            self.log_progress(time.monotonic() - start)
+
+    def log_progress(self, elapsed):
+        """
+        输出当前进度
+        :params elapsed: 已运行的秒数
+        """
+        written = metrics.get("files_written_total")
+        logger.info(f"<progress> <files> {self.file_num}/{self.task_len} <pids> {self.done_num}/{self.task_num} "
+                    f"<written> {written} <errors> {metrics.get('illust_errors_total')} "
+                    f"<files/s> {written / max(elapsed, 1):.1f}")
 
+    def close_plan(self, cancelled=False):
+        """
+        统计计划中的 新标签、文件标签、新增/替换的备注 与 需要加入Artist的作者标签，写入计划文件
+        :params cancelled: 程序是否被中断，中断时计划被标记为不完整，写入时会被拒绝
+        """
+        alias = artist_alias if self.is_v3_db else None
+        new_tags = sorted(i for i in self.plan.tag_names if self.tag_index.get(i, alias) is None)
+        replace = len(self.db_tool.query_in(
+            "SELECT file_id FROM bf_material_userdata WHERE file_id IN ({})", self.plan.note_files))
+        artists = []
+        if self.is_v3_db:
+            artists = [i["name"] for i in self.db_tool.get_artists_id()] + [
+                i for i in new_tags if artist_alias(i) is not None]
+        summary = {"complete": not cancelled, "new_tags": new_tags, "joins": self.plan.join_count,
+                   "notes_insert": len(self.plan.note_files) - replace, "notes_replace": replace,
+                   "artist_reparent": artists}
+        self.plan.close(summary)
+        logger.info(f"<plan> {self.plan.path} 未修改数据库")
+        if cancelled:
+            logger.warning("<plan> 程序被中断，计划不完整，重新运行 PLAN = \"write\" 生成完整的计划")
+        logger.info(f"<plan> <new tags> {len(new_tags)} <joins> {summary['joins']} "
+                    f"<notes insert> {summary['notes_insert']} <notes replace> {replace} "
+                    f"<artist reparent> {len(artists)}")
+
+    def close_metrics(self):
+        stop_metrics(self.metrics_server, self.metrics_writer)
+
+    def on_interrupt(self, signum, frame):
+        """
+        Ctrl+C 的处理函数，停止分发任务并唤醒主线程
+        """
+        logger.warning("<interrupt> 正在停止，已完成的内容会写入数据库，再次 Ctrl+C 强制退出")
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        self.cancelled = True
+        self.done_event.set()
+        self.stop_event.set()
+
+    def watch(self, last_id):
+        """
+        监视模式，定时检查数据库，处理 bf_file.id 大于 last_id 的新文件
+        使用一个长期连接读取 PRAGMA data_version，只有其他连接(如Billfish)修改过数据库时才查询新文件
+        并重新读取标签索引，避免使用Billfish已删除或修改过的标签id
+        :params last_id: 已处理的最大 bf_file.id
+        """
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self.on_interrupt)
+        open_event_log()
+        # 监视期间不使用导入会话与进度记录，每次写入都是一个短事务，不影响Billfish使用
+        self.parse_stage = None
+        self.plan = None
+        self.journal = None
+        self.db_writer = db_writer(self.db_tool, self.is_v3_db, self.tag_index)
+        pool = ThreadPool(FETCH_Thread, FETCH_QUEUE_SIZE)
+        conn = self.db_tool.connect_db()
+        version = None
+        logger.info(f"<watch> <last_id> {last_id} <interval> {WATCH_INTERVAL}s")
+        try:
+            while not self.stop_event.wait(0 if version is None else WATCH_INTERVAL):
+                try:
+                    current = conn.execute("PRAGMA data_version").fetchone()[0]
+                    if current == version:
+                        continue
+                    hi = self.db_tool.max_file_id(conn)
+                    if version is not None:
+                        self.tag_index.reset(conn.execute(
+                            "SELECT id,name FROM {}".format("bf_tag_v2" if self.is_v3_db else "bf_tag")))
+                except sqlite3.OperationalError:
+                    # 数据库被占用，下次再检查
+                    continue
+                version = current
+                if hi > last_id:
+                    self.watch_batch((last_id, hi), pool)
+                    last_id = hi
+        finally:
+            self.db_tool.close_db(conn)
+            pool.terminate(CANCEL_TIMEOUT)
+            self.db_writer.close(self.cancelled)
+            logger.info(f"<watch> <last_id> {last_id} <db_writer> <commit> {self.db_writer.commit_count} "
+                        f"<rows> {self.db_writer.row_count}")
+            close_event_log()
+
+    def watch_batch(self, id_range, pool):
+        """
+        获取并写入一批新文件，等待这一批全部完成
+        :params id_range: (lo, hi) 处理 lo < id <= hi 的文件
+        :params pool: ThreadPool
+        """
+        start = self.file_num
+        futures = []
+        for task in self.iter_task(id_range, WATCH_BATCH):
+            if self.cancelled:
+                break
+            futures.append(pool.put(self.thread_task, task, self.task_callback))
+        futures = [i for i in futures if i is not None]
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                pass
+        if self.file_num > start:
+            logger.info(f"<watch> <files> {self.file_num - start} <pids> {len(futures)} "
+                        f"<bf_file.id> {id_range[0] + 1}-{id_range[1]}")
+
+    def iter_task(self, id_range=None, chunk=None):
+        """
+        分块读取 bf_file，按pid分组并筛选出需要写入的文件
+        :params id_range: (lo, hi) 读取 lo < id <= hi 的文件，None 为按 START_FILE_NUM END_FILE_NUM
+        :params chunk: 每块的文件数，None 为 FILE_CHUNK
+        :return: 生成器 (pid, tag_files, note_files, num)
+        """
+        # 每块最后一个pid的文件可能延续到下一块，留到下一块一起处理
+        carry = []
+        for chunk in self.db_tool.iter_file_name(id_range, chunk):
+            pid_group, un_file = group_by_pid(carry + chunk)
+            carry = pid_group.pop(get_pid(chunk[-1]["name"]), [])
+            self.count_un_file(un_file)
+            yield from self.iter_group_task(pid_group)
+        if carry:
+            yield from self.iter_group_task({get_pid(carry[0]["name"]): carry})
+
+    def iter_group_task(self, pid_group):
+        """
+        批量查询一块文件的 已有标签/备注 与 已完成 状态，再逐个pid筛选
+        :params pid_group: {pid: [bf_file, ...]}
+        :return: 生成器 (pid, tag_files, note_files, num)
+        """
+        file_ids = [i["id"] for files in pid_group.values() for i in files]
+        if SKIP and PENDING_QUERY:
+            # 读取文件时已一并查询
+            self.tag_file_index = {i["id"] for files in pid_group.values() for i in files if i["has_tag"]}
+            self.note_file_index = {i["id"] for files in pid_group.values() for i in files if i["has_note"]}
         else:
-            logger.error("数据库中没有文件")
+            self.tag_file_index = self.db_tool.get_tag_file_id(file_ids) if WRITE_TAG and SKIP else set()
+            self.note_file_index = self.db_tool.get_note_file_id(file_ids) if WRITE_NOTE and SKIP else set()
+        if self.journal is not None:
+            self.tag_done_index = self.journal.done("tag", file_ids) if WRITE_TAG else set()
+            self.note_done_index = self.journal.done("note", file_ids) if WRITE_NOTE else set()
+        for pid, files in pid_group.items():
+            self.file_num += len(files)
+            task = self.prepare_task(pid, files, self.file_num)
+            if task is not None:
+                self.add_count(task_num=1)
+                yield (pid,) + task + (self.file_num,)
+
+    def count_un_file(self, un_file):
+        """
+        记录无法识别的文件
+        :params un_file: [bf_file, ...]
+        """
+        for i in un_file:
+            if event_log is not None:
+                event_log.write("unrecognized", file_id=i["id"], name=i["name"])
+            if not QUIET:
+                logger.info(f"<name> {i['name']} <un_count>")
+        self.file_num += len(un_file)
+        self.add_count(tag_count=len(un_file), note_count=len(un_file),
+                       tag_un_count=len(un_file), note_un_count=len(un_file))
+
+    def add_count(self, **counts):
+        """
+        线程安全地增加计数
+        :params counts: 计数名=增加量，如 tag_success_count=3
+        """
+        with self.count_lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+            self.check_done()
+
+    def check_done(self):
+        """
+        任务已全部放入且全部完成时触发 done_event，需持有 count_lock
+        """
+        if self.dispatch_done and self.done_num >= self.task_num:
+            self.done_event.set()
+
+    def set_dispatch_done(self):
+        """
+        所有任务已放入
+        """
+        with self.count_lock:
+            self.dispatch_done = True
+            self.check_done()
+
+    def dispatch_failed(self, e):
+        """
+        分发任务或请求引擎异常结束时停止运行并唤醒主线程，已放入的任务可能永远不会完成，不能等待其计数
+        :params e: 异常
+        """
+        logger.opt(exception=e).error("<dispatch> 分发任务失败，正在停止 Exception:{!r}".format(e))
+        self.cancelled = True
+        self.done_event.set()
 
     @logger.catch
-    def thread_task_for(self, flag, bf_file, ):
+    def thread_task_for(self, ):
         try:
-            for _ in range(0, len(list(bf_file))):
-                if flag == "note":
-                    NOTE_TOOL.put(self.thread_task_note, (bf_file[_], _ + 1,), callback)
-                elif flag == "tag":
-                    TAG_TOOL.put(self.thread_task_tag, (bf_file[_], _ + 1,), callback)
-                else:
-                    logger.error(f"参数错误!")
-                    exit()
+            for task in self.iter_task():
+                if self.cancelled:
+                    break
+                FETCH_TOOL.put(self.thread_task, task, self.task_callback)
 
         except Exception as e:
-            logger.error("Exception:{}".format(e))
-            if flag == "note":
-                NOTE_TOOL.close()
-            if flag == "tag":
-                TAG_TOOL.close()
+            self.dispatch_failed(e)
 
         finally:
-            if flag == "note":
-                NOTE_TOOL.close()
-            if flag == "tag":
-                TAG_TOOL.close()
+            self.set_dispatch_done()
 
-    @logger.catch
-    # 写入标签线程
-    def thread_task_tag(self, _, num, ):
+    def task_callback(self, success, result):
         """
-        线程任务函数
-        :params _: 文件列表
-        :params num: 当前序号
+        线程池任务的回调函数，记录执行失败的任务
+        :params success: 任务是否执行成功
+        :params result: 任务的返回值，失败时为异常
         """
-        # 文件在bf_file 中的id，name
-        file_id = _["id"]
-        name = _["name"]
-
-        logger.info(f"<{num}/{self.task_len}> <name> {name} <Start>")
-        pid = get_pid(name)
-        # 成功识别
-        if pid:
-            self.tag__count += 1
-        # 无法识别
-        else:
-            self.tag_count += 1
-            self.tag_un_count += 1
-            logger.info(f"<{num}/{self.task_len}> <name> {name} <un_count>")
-            self.done_num += 1
-            return
+        if not success:
+            logger.opt(exception=result).error("<task failed> {!r}".format(result))
 
-        # 写入标签
-        if check_file_tag_exist(file_id) and SKIP:
-            self.tag_count += 1
-            self.tag_pass_count += 1
-            logger.info(f"<{num}/{self.task_len}> <name> {name} <Skip>")
-            self.done_num += 1
-            return
-        else:
-            tag_list = get_tags(pid)
+    @logger.catch
+    def async_task_for(self, ):
+        """
+        使用 async_fetch.AsyncFetcher 获取作品信息，缓存中已有的作品不发出请求
+        """
+        def jobs():
+            for pid, tag_files, note_files, num in self.iter_task():
+                if self.cancelled:
+                    return
+                cached = local_illust(pid)
+                if cached is not None:
+                    self.parse_task(pid, tag_files, note_files, num, cached, True)
+                    continue
+                elif OFFLINE:
+                    self.write_task(pid, tag_files, note_files, num, get_illust(pid))
+                    continue
+                yield f"{temp_url}{pid}", (pid, tag_files, note_files, num)
+
+        def handler(arg, resp):
+            self.parse_task(*arg, resp)
 
-            if not tag_list:
-                logger.warning(f"<{num}/{self.task_len}> <name> {name} <NULL Tags>")
-                self.tag_count += 1
-                self.tag_pass_count += 1
-                self.done_num += 1
+        try:
+            try:
+                from async_fetch import AsyncFetcher
+            except ImportError as e:
+                logger.error(f"FETCH_ENGINE = \"async\" 需要安装 aiohttp: pip install aiohttp Exception:{e}")
+                self.cancelled = True
+                self.done_event.set()
                 return
+            fetcher = AsyncFetcher(ASYNC_LIMIT, headers, proxies["https"] if useProxies else None,
+                                   limiter=rate_limiter, metrics=metrics)
+            fetcher.run(jobs(), handler, self.task_callback)
+        except Exception as e:
+            self.dispatch_failed(e)
+        finally:
+            self.set_dispatch_done()
 
-        # 写入
-        if tag_list:
-            self.write_tag_list(file_id, tag_list, self.is_v3_db)
-            self.write_tag_in_db(False)
-            self.write_tag_join_file_db(False)
-            self.tag_success_count += 1
-            logger.info(f"<{num}/{self.task_len}> <name> {name} <Written>")
-        self.done_num += 1
-        self.tag_count += 1
-
-    # 写入备注线程
     @logger.catch
-    def thread_task_note(self, _, num, ):
+    def batch_task_for(self, ):
         """
-        线程任务函数
-        :params _: 文件列表
-        :params num: 当前序号
+        FETCH_ENGINE = "batch" 时使用，需要备注的作品逐个获取，只需要标签的作品先读取全部，
+        再逐个取出尚未获取的作品交给 batch_task，由其得到画师后一并获取该画师的其他作品
         """
-        # 文件在bf_file 中的id，name
-        id = _["id"]
-        name = _["name"]
+        self.batch_fetcher = BatchFetcher(fetch_url, user_url, BATCH_SIZE, metrics, BATCH_LOSSY)
+        # pid -> task 尚未获取的作品
+        self.batch_pending = {}
+        self.batch_lock = threading.Lock()
+        try:
+            for task in self.iter_task():
+                if self.cancelled:
+                    break
+                pid, tag_files, note_files, num = task
+                cached = local_illust(pid)
+                if cached is not None:
+                    self.parse_task(pid, tag_files, note_files, num, cached, True)
+                elif note_files or OFFLINE:
+                    FETCH_TOOL.put(self.thread_task, task, self.task_callback)
+                else:
+                    self.batch_pending[pid] = task
+            for pid in list(self.batch_pending):
+                if self.cancelled:
+                    break
+                if pid in self.batch_pending:
+                    FETCH_TOOL.put(self.batch_task, (pid,), self.task_callback)
 
-        logger.info(f"<{num}/{self.task_len}> <name> {name} <Start>")
-        pid = get_pid(name)
-        # 成功识别
-        if pid:
-            self.note__count += 1
-        # 无法识别
-        else:
-            self.note_count += 1
-            self.note_un_count += 1
-            logger.info(f"<{num}/{self.task_len}> <name> {name} <un_count>")
-            self.done_num += 1
-            return
+        except Exception as e:
+            self.dispatch_failed(e)
 
-        # 写入标签
-        if check_note_exist(id) and SKIP:
-            self.note_count += 1
-            self.note_pass_count += 1
-            logger.info(f"<{num}/{self.task_len}> <name> {name} <Skip>")
-            self.done_num += 1
+        finally:
+            self.set_dispatch_done()
+
+    def batch_task(self, pid):
+        """
+        逐个获取一个作品，再按其画师批量获取其他尚未获取的作品
+        批量接口未返回的作品(如已删除、含有翻译未知的标签)仍逐个获取
+        :params pid: pixiv插画id
+        """
+        with self.batch_lock:
+            task = self.batch_pending.pop(pid, None)
+        if task is None:
+            # 已与同一画师的其他作品一起获取
             return
-        else:
-            note = get_note(pid)
+        json_data = self.batch_single_task(*task)
+        if json_data is None:
+            return
+        uid = json_data["body"]["userId"]
+        works = self.batch_fetcher.user_works(uid, json_data)
+        with self.batch_lock:
+            tasks = [self.batch_pending.pop(i) for i in works if i in self.batch_pending]
+        if not tasks:
+            return
+        try:
+            result = self.batch_fetcher.fetch(uid, [i[0] for i in tasks])
+        except Exception as e:
+            logger.error("<batch> <uid> {} Exception:{!r}".format(uid, e))
+            result = {}
+        for task in tasks:
+            try:
+                resp = result.get(task[0])
+                if resp is None:
+                    self.batch_single_task(*task)
+                else:
+                    # 批量接口的内容不完整，不写入缓存
+                    self.parse_task(*task, resp, True)
+            except Exception as e:
+                self.task_callback(False, e)
 
-            if note == "":
-                logger.warning(f"<{num}/{self.task_len}> <name> {name} <NULL Note>")
-                self.note_count += 1
-                self.note_pass_count += 1
-                self.done_num += 1
-                return
+    def batch_single_task(self, pid, tag_files, note_files, num):
+        """
+        逐个获取一个作品并写入，记录其中的标签翻译供批量结果使用
+        :return: 作品信息 json_data，获取失败时为 None
+        """
+        try:
+            resp, cached = fetch_illust(pid)
+        except Exception:
+            self.add_count(done_num=1)
+            raise
+        self.parse_task(pid, tag_files, note_files, num, resp, cached)
+        try:
+            json_data = load_illust(resp)
+        except ValueError:
+            return None
+        if json_data is None or json_data.get("error") or json_data.get("status") == 404:
+            return None
+        self.batch_fetcher.learn(json_data)
+        return json_data
+
+    # 获取作品信息并写入标签与备注
+    def thread_task(self, pid, tag_files, note_files, num, ):
+        """
+        线程任务函数，每个作品只请求一次作品信息，同时生成该作品所有文件的标签与备注
+        :params pid: pixiv插画id
+        :params tag_files: 需要写入标签的文件id
+        :params note_files: 需要写入备注的文件id
+        :params num: 当前序号
+        """
+        try:
+            resp, cached = fetch_illust(pid)
+        except Exception:
+            self.add_count(done_num=1)
+            raise
+        if resp is None and OFFLINE:
+            self.write_task(pid, tag_files, note_files, num, None)
+        else:
+            self.parse_task(pid, tag_files, note_files, num, resp, cached)
 
-        # 写入
-        if note:
-            origin = origin_url + pid
-            self.write_note_list(id, note, origin)
-            self.write_note_join_file_db(False)
-            self.note_success_count += 1
-        time.sleep(0.1)
-        logger.info(f"<{num}/{self.task_len}> <name> {name} <Written>")
-        self.done_num += 1
-        self.note_count += 1
-
-    def write_tag_list(self, file_id, tag_list, is_v3_db):
-        """
-        写入临时标签，'prepare_tag'
-        :params file_id: file_id
-        :params tag_list: 将要写入的tag列表
+    def parse_task(self, pid, tag_files, note_files, num, resp, cached=False):
+        """
+        由原始返回内容生成标签与备注并写入，PARSE_PROCESS 时交给解析进程
+        :params pid: pixiv插画id
+        :params tag_files: 需要写入标签的文件id
+        :params note_files: 需要写入备注的文件id
+        :params num: 当前序号
+        :params resp: (status_code, text) or None (请求失败)
+        :params cached: resp 是否来自缓存
         """
-        for i in tag_list:
-            tag_id = check_tag_exist(i, is_v3_db)
-            if tag_id:
-                prepare_tag_join_file.append({'file_id': str(file_id), 'tag_id': str(tag_id)})
+        if self.parse_stage is not None:
+            self.parse_stage.put((pid, tag_files, note_files, num), resp, cached, bool(tag_files), bool(note_files))
+            return
+        try:
+            json_data = parse_illust(pid, resp, cached)
+        except Exception as e:
+            logger.error("<pid> {} Exception:{!r}".format(pid, e))
+            json_data = None
+        self.write_task(pid, tag_files, note_files, num, json_data)
 
-            else:
-                if not self.WRITING_TAG:
-                    self.WRITING_TAG = 1
-                    if tag_id_list != []:
-                        tag_id = int(tag_id_list[len(tag_id_list) - 1]) + 1
-                        prepare_tag.append({"id": str(tag_id), "name": str(i)})
-                        prepare_tag_join_file.append({"file_id": str(file_id), "tag_id": str(tag_id)})
-                        tag_id_list.append(tag_id)
-                        tag_name_list.append(i)
-                        self.WRITING_TAG = 0
+    def prepare_task(self, pid, files, num):
+        """
+        筛选出该pid下需要写入标签/备注的文件
+        :params pid: pixiv插画id
+        :params files: 属于该pid的文件列表
+        :params num: 当前序号
+        :return: (tag_files, note_files) or None (全部跳过)
+        """
+        if not QUIET:
+            logger.info(f"<{num}/{self.task_len}> <pid> {pid} <files> {len(files)} <Start>")
+        self.add_count(tag_count=len(files), note_count=len(files), tag__count=len(files), note__count=len(files))
+
+        # 已有内容的文件跳过
+        tag_files = []
+        note_files = []
+        tag_pass = 0
+        note_pass = 0
+        for _ in files:
+            # 文件在bf_file 中的id
+            file_id = _["id"]
+            if WRITE_TAG:
+                if (self.check_file_tag_exist(file_id) and SKIP) or file_id in self.tag_done_index:
+                    tag_pass += 1
+                else:
+                    tag_files.append(file_id)
+            if WRITE_NOTE:
+                if (self.check_note_exist(file_id) and SKIP) or file_id in self.note_done_index:
+                    note_pass += 1
+                else:
+                    note_files.append(file_id)
+        self.add_count(tag_pass_count=tag_pass, note_pass_count=note_pass)
+        if not (tag_files or note_files):
+            if event_log is not None:
+                event_log.write("skip", pid=pid, files=len(files))
+            if not QUIET:
+                logger.info(f"<{num}/{self.task_len}> <pid> {pid} <Skip>")
+            return None
+        return tag_files, note_files
+
+    def write_task(self, pid, tag_files, note_files, num, json_data):
+        """
+        由作品信息生成标签与备注，写入该pid下的文件
+        :params pid: pixiv插画id
+        :params tag_files: 需要写入标签的文件id
+        :params note_files: 需要写入备注的文件id
+        :params num: 当前序号
+        :params json_data: get_illust 的返回值
+        """
+        try:
+            tag_list = build_tags(json_data) if tag_files else []
+            note = build_note(json_data) if note_files else ""
+        except Exception:
+            self.add_count(done_num=1)
+            raise
+        self.write_result(pid, tag_files, note_files, num, tag_list, note)
+
+    def write_result(self, pid, tag_files, note_files, num, tag_list, note):
+        """
+        将标签与备注写入该pid下的文件
+        :params pid: pixiv插画id
+        :params tag_files: 需要写入标签的文件id
+        :params note_files: 需要写入备注的文件id
+        :params num: 当前序号
+        :params tag_list: 标签列表
+        :params note: 备注
+        """
+        try:
+            # 写入标签
+            if tag_files:
+                if tag_list:
+                    if self.plan is not None:
+                        self.plan.put_tags(pid, tag_files, tag_list)
+                    else:
+                        self.write_tag_list(tag_files, tag_list, self.is_v3_db)
+                        self.db_writer.put("pid", [("tag", pid)])
+                    self.add_count(tag_success_count=len(tag_files))
+                else:
+                    if not QUIET:
+                        logger.warning(f"<{num}/{self.task_len}> <pid> {pid} <NULL Tags>")
+                    self.add_count(tag_pass_count=len(tag_files))
+
+            # 写入备注
+            if note_files:
+                if note:
+                    origin = origin_url + pid
+                    if self.plan is not None:
+                        self.plan.put_note(pid, note_files, note, origin)
                     else:
-                        tag_id = 1
-                        prepare_tag.append({"id": str(tag_id), "name": str(i)})
-                        prepare_tag_join_file.append({"file_id": str(file_id), "tag_id": str(tag_id)})
-                        tag_id_list.append(tag_id)
-                        tag_name_list.append(i)
-                        self.WRITING_TAG = 0
+                        self.write_note_list(note_files, note, origin)
+                        self.db_writer.put("pid", [("note", pid)])
+                    self.add_count(note_success_count=len(note_files))
                 else:
-                    time.sleep(0.3)
-                    self.write_tag_list(file_id, tag_list, is_v3_db)
+                    if not QUIET:
+                        logger.warning(f"<{num}/{self.task_len}> <pid> {pid} <NULL Note>")
+                    self.add_count(note_pass_count=len(note_files))
+
+            if event_log is not None:
+                event_log.write("written", pid=pid, tag_files=len(tag_files) if tag_list else 0,
+                                note_files=len(note_files) if note else 0, tags=len(tag_list))
+            if not QUIET:
+                logger.info(f"<{num}/{self.task_len}> <pid> {pid} <Written>")
+            metrics.inc("files_written_total", len(set(tag_files) | set(note_files)))
+        finally:
+            # 出错时同样计为完成，避免主线程一直等待
+            self.add_count(done_num=1)
 
-    def write_note_list(self, file_id, note, origin):
+    # 检查标签是否存在
+    def check_tag_exist(self, tag_name, is_v3_db):
+        """
+       检查标签是否存在
+       :params tag_name: 标签名
+       :parma is_v3_db: 是否为3.0版本的新数据库
+       :return: bf_tag.id or False
+       """
+        tag_id = self.tag_index.get(tag_name, artist_alias if is_v3_db else None)
+        return tag_id if tag_id is not None else False
+
+    # 检查文件是否已经有标签
+    def check_file_tag_exist(self, file_id):
         """
-        写入临时备注，'prepare_note_join_file'
-        :params file_id: file_id
+       检查文件是否已经有标签
+       :params file_id: 文件id bf_file.id
+       :return: True or False
+       """
+        return file_id in self.tag_file_index
+
+    # 检测文件是否已有备注
+    def check_note_exist(self, file_id):
+        """
+      检查文件是否已经有备注
+      :params file_id: 文件id bf_file.id
+      :return: True or False
+      """
+        return file_id in self.note_file_index
+
+    def write_tag_list(self, file_ids, tag_list, is_v3_db):
+        """
+        将标签交给写入线程 db_writer
+        :params file_ids: 需要写入标签的文件id
+        :params tag_list: 将要写入的tag列表
+        """
+        # 以标签名交给写入线程，新标签在提交时写入并取得id
+        rows = tag_rows(tag_list, self.artist_id if is_v3_db else None)
+        self.db_writer.put("join", [(file_id, name, pid) for name, pid in rows for file_id in file_ids])
+
+    def write_note_list(self, file_ids, note, origin):
+        """
+        将备注交给写入线程 db_writer
+        :params file_ids: 需要写入备注的文件id
         :params note: 将要写入的备注
         :params origin: 原图链接
         """
+        self.db_writer.put("note", [(file_id, note, origin) for file_id in file_ids])
 
-        prepare_note_join_file.append({"file_id": file_id, "note": note, "origin": origin})
 
-    def write_tag_in_db(self, flag):
-        if (len(prepare_tag) >= 20 or flag) and not self.WRITING:
-            self.WRITING = 1
-            if self.db_tool.write_tag_db(prepare_tag, self.is_v3_db):
-                self.WRITING = 0
-                prepare_tag.clear()
-                return True
-        else:
-            return False
+class multi_library:
+    """
+    多素材库模式，所有素材库共用获取线程、限速器与缓存
+    先读取全部素材库并按pid合并任务，每个作品只获取与解析一次，再交给各素材库各自的写入线程
+    """
 
-    def write_tag_join_file_db(self, flag):
-        if (len(prepare_tag_join_file) >= 50 or flag) and not self.WRITING:
-            self.WRITING = 1
-            if self.db_tool.write_tag_join_file_db(prepare_tag_join_file):
-                self.WRITING = 0
-                prepare_tag_join_file.clear()
-                return True
-        else:
-            return False
+    def __init__(self, paths):
+        """
+        :param paths: 数据库路径列表
+        """
+        if PLAN:
+            logger.error("多素材库模式(DB_PATHS)不支持 PLAN，请逐个素材库生成与写入计划")
+            exit(0)
+        if WATCH:
+            logger.warning("多素材库模式(DB_PATHS)不支持 WATCH，处理完成后将退出")
+        self.libraries = []
+        for path in dict.fromkeys(os.path.abspath(i) for i in paths):
+            logger.info(f"<library> {path}")
+            library = pixiv2Billfish(path)
+            if library.task_len:
+                self.libraries.append(library)
+        self.task_num = 0
+        self.done_num = 0
+        self.count_lock = threading.Lock()
+        self.done_event = threading.Event()
+        self.cancelled = False
+        self.dispatch_done = False
 
-    def write_note_join_file_db(self, flag):
-        if (len(prepare_note_join_file) >= 10 or flag) and not self.WRITING:
-            self.WRITING = 1
-            if self.db_tool.write_note(prepare_note_join_file):
-                self.WRITING = 0
-                prepare_note_join_file.clear()
-                return True
+    def main(self):
+        if not self.libraries:
+            return
+        for library in self.libraries:
+            library.open_writer()
+        self.open_metrics()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self.on_interrupt)
+        try:
+            tasks = self.collect_task()
+            if QUIET:
+                threading.Thread(target=self.progress_task, name="progress", daemon=True).start()
+            if FETCH_ENGINE == "async":
+                self.async_task_for(tasks)
+            else:
+                self.thread_task_for(tasks)
+            while not self.done_event.wait(1):
+                pass
+        except Exception as e:
+            logger.error("Exception:{}".format(e))
+            self.cancelled = True
+        if self.cancelled:
+            if not FETCH_TOOL.terminate(CANCEL_TIMEOUT):
+                logger.warning(f"<FETCH_TOOL> {CANCEL_TIMEOUT}s 内未能结束所有任务")
         else:
+            FETCH_TOOL.close()
+
+        logger.info(f"<FETCH_TOOL> <max_num> {FETCH_TOOL.max_num} <threads> {len(FETCH_TOOL.generate_list)} "
+                    f"<success> {FETCH_TOOL.success_count} <failed> {FETCH_TOOL.fail_count}")
+        for library in self.libraries:
+            logger.info(f"<library> {library.db_path}")
+            library.log_summary()
+            library.close_writer(self.cancelled)
+        stop_metrics(self.metrics_server, self.metrics_writer)
+        close_event_log()
+
+    def open_metrics(self):
+        """
+        注册合并后的任务数与各素材库写入线程的合计，按设置启动 /metrics 服务与快照写入
+        """
+        metrics.gauge_func("libraries", lambda: len(self.libraries))
+        metrics.gauge_func("files_total", lambda: sum(i.task_len for i in self.libraries))
+        metrics.gauge_func("tasks_dispatched", lambda: self.task_num)
+        metrics.gauge_func("tasks_done", lambda: self.done_num)
+        metrics.gauge_func("fetch_queue", FETCH_TOOL.q.qsize)
+        metrics.gauge_func("write_queue", lambda: sum(i.db_writer.q.qsize() for i in self.libraries))
+        metrics.gauge_func("commits", lambda: sum(i.db_writer.commit_count for i in self.libraries))
+        self.metrics_server, self.metrics_writer = start_metrics()
+
+    def on_interrupt(self, signum, frame):
+        """
+        Ctrl+C 的处理函数，停止分发任务并唤醒主线程
+        """
+        logger.warning("<interrupt> 正在停止，已完成的内容会写入数据库，再次 Ctrl+C 强制退出")
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        self.cancelled = True
+        self.done_event.set()
+
+    def collect_task(self):
+        """
+        读取所有素材库中需要处理的文件，按pid合并
+        :return: {pid: [(library, tag_files, note_files, num), ...]}
+        """
+        tasks = {}
+        total = 0
+        for library in self.libraries:
+            for pid, tag_files, note_files, num in library.iter_task():
+                tasks.setdefault(pid, []).append((library, tag_files, note_files, num))
+                total += 1
+            library.set_dispatch_done()
+        self.task_num = len(tasks)
+        logger.info(f"<multi_library> <libraries> {len(self.libraries)} <pids> {total} <unique pids> {len(tasks)}")
+        return tasks
+
+    def progress_task(self):
+        """
+        QUIET 时每 PROGRESS_INTERVAL 秒输出一次进度
+        """
+        start = time.monotonic()
+        while not self.done_event.wait(PROGRESS_INTERVAL):
+            written = metrics.get("files_written_total")
+            logger.info(f"<progress> <pids> {self.done_num}/{self.task_num} <written> {written} "
+                        f"<errors> {metrics.get('illust_errors_total')} "
+                        f"<files/s> {written / max(time.monotonic() - start, 1):.1f}")
+
+    def add_done(self):
+        with self.count_lock:
+            self.done_num += 1
+            self.check_done()
+
+    def check_done(self):
+        """
+        任务已全部放入且全部完成时触发 done_event，需持有 count_lock
+        """
+        if self.dispatch_done and self.done_num >= self.task_num:
+            self.done_event.set()
+
+    def set_dispatch_done(self):
+        with self.count_lock:
+            self.dispatch_done = True
+            self.check_done()
+
+    def thread_task_for(self, tasks):
+        try:
+            for pid, targets in tasks.items():
+                if self.cancelled:
+                    break
+                FETCH_TOOL.put(self.thread_task, (pid, targets), self.task_callback)
+        finally:
+            self.set_dispatch_done()
+
+    def task_callback(self, success, result):
+        if not success:
+            logger.opt(exception=result).error("<task failed> {!r}".format(result))
+
+    def async_task_for(self, tasks):
+        """
+        使用 async_fetch.AsyncFetcher 获取作品信息，缓存中已有的作品不发出请求
+        """
+        def jobs():
+            for pid, targets in tasks.items():
+                if self.cancelled:
+                    return
+                cached = local_illust(pid)
+                if cached is not None:
+                    self.write_targets(pid, targets, cached, True)
+                elif OFFLINE:
+                    self.write_targets(pid, targets, *fetch_illust(pid))
+                else:
+                    yield f"{temp_url}{pid}", (pid, targets)
+
+        def handler(arg, resp):
+            self.write_targets(*arg, resp)
+
+        try:
+            try:
+                from async_fetch import AsyncFetcher
+            except ImportError as e:
+                logger.error(f"FETCH_ENGINE = \"async\" 需要安装 aiohttp: pip install aiohttp Exception:{e}")
+                self.cancelled = True
+                self.done_event.set()
+                return
+            fetcher = AsyncFetcher(ASYNC_LIMIT, headers, proxies["https"] if useProxies else None,
+                                   limiter=rate_limiter, metrics=metrics)
+            fetcher.run(jobs(), handler, self.task_callback)
+        finally:
+            self.set_dispatch_done()
+
+    def thread_task(self, pid, targets):
+        """
+        线程任务函数，获取一次作品信息，写入所有素材库中该pid的文件
+        :params pid: pixiv插画id
+        :params targets: [(library, tag_files, note_files, num), ...]
+        """
+        try:
+            resp, cached = fetch_illust(pid)
+        except Exception:
+            self.add_done()
+            raise
+        self.write_targets(pid, targets, resp, cached)
+
+    def write_targets(self, pid, targets, resp, cached=False):
+        """
+        解析一次作品信息，生成的标签与备注分别交给各素材库写入
+        :params pid: pixiv插画id
+        :params targets: [(library, tag_files, note_files, num), ...]
+        :params resp: (status_code, text) or None (请求失败)
+        :params cached: resp 是否来自缓存
+        """
+        try:
+            json_data = None if resp is None and OFFLINE else parse_illust(pid, resp, cached)
+            tag_list = build_tags(json_data) if WRITE_TAG else []
+            note = build_note(json_data) if WRITE_NOTE else ""
+        except Exception as e:
+            logger.error("<pid> {} Exception:{!r}".format(pid, e))
+            tag_list, note = [], ""
+        try:
+            for library, tag_files, note_files, num in targets:
+                try:
+                    library.write_result(pid, tag_files, note_files, num, tag_list, note)
+                except Exception as e:
+                    logger.error("<library> {} <pid> {} Exception:{!r}".format(library.db_path, pid, e))
+        finally:
+            self.add_done()
+
+
+# 写入导入计划
+def apply_plan():
+    """
+    读取 PLAN_PATH 中的导入计划，在一个事务中写入数据库，标签在写入时按名称查找或分配id
+    失败时回滚，数据库不会被部分修改
+    :return: 是否写入成功
+    """
+    path = os.path.join(log_path, PLAN_PATH)
+    if not os.path.isfile(path):
+        logger.error(f"<PLAN_PATH> 未找到计划文件：{path}")
+        return False
+    header, summary, records = read_plan(path)
+    tool = db_tool()
+    is_v3_db = tool.is_db_ver_3()
+    if header["v3"] != is_v3_db:
+        logger.error("<plan> 计划文件与数据库版本不一致")
+        return False
+    if header["library"] != os.path.abspath(DB_PATH):
+        if not PLAN_FORCE:
+            logger.error(f"<plan> 计划文件由 {header['library']} 生成，与当前素材库 {os.path.abspath(DB_PATH)} 不一致，"
+                         f"确认无误可设置 PLAN_FORCE = 1")
+            return False
+        logger.warning(f"<plan> 计划文件由 {header['library']} 生成，PLAN_FORCE = 1 仍写入")
+    # 没有统计信息(生成时崩溃)或生成时被中断的计划只包含部分作品
+    if summary is None or not summary.get("complete"):
+        if not PLAN_FORCE:
+            logger.error("<plan> 计划文件不完整(生成时被中断或出错)，请重新运行 PLAN = \"write\"，"
+                         "确认只写入其中的部分内容可设置 PLAN_FORCE = 1")
             return False
+        logger.warning("<plan> 计划文件不完整，PLAN_FORCE = 1 仍写入")
+
+    conn = tool.open_session() if IMPORT_SESSION else tool.connect_db()
+    conn.isolation_level = None
+    tag_num = join_num = note_num = 0
+    start = time.monotonic()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        # Artist父标签与旧的 Artist:ID 标签也在同一个事务中处理，失败时一并回滚
+        artist_id = None
+        if is_v3_db:
+            artist_id = tool.get_artist_id_in(conn)
+            tool.migrate_artist_tags(artist_id, conn)
+        tag_index = TagIndex((row[0], row[1]) for row in conn.execute(
+            "SELECT id,name FROM {}".format("bf_tag_v2" if is_v3_db else "bf_tag")))
+        for record in records:
+            if "tags" in record:
+                rows = tag_rows(record["tags"], artist_id)
+                found, new_num = tool.write_tag_db(conn, tag_index, rows, is_v3_db)
+                # 整个计划在同一个事务中，失败时全部回滚，可直接加入索引
+                tag_index.update(found)
+                tool.write_tag_join_file_db(conn, [(file_id, tag_index.get(name)) for name, _ in rows
+                                                   for file_id in record["files"]])
+                tag_num += new_num
+                join_num += len(rows) * len(record["files"])
+            else:
+                tool.write_note(conn, [(file_id, record["note"], record["origin"]) for file_id in record["files"]])
+                note_num += len(record["files"])
+        conn.execute("COMMIT")
+    except Exception as e:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        logger.error("<plan> 写入失败，数据库未修改 Exception:{}".format(e))
+        tool.close_session()
+        return False
+    finally:
+        if not IMPORT_SESSION:
+            tool.close_db(conn)
+    logger.info(f"<plan> <new tags> {tag_num} <joins> {join_num} <notes> {note_num} "
+                f"<seconds> {time.monotonic() - start:.2f}")
+    tool.close_session()
+    return True
 
 
 if __name__ == '__main__':
-    test = pixiv2Billfish()
-    test.main()
+    if PLAN == "apply":
+        apply_plan()
+    elif DB_PATHS:
+        multi_library(DB_PATHS).main()
+    else:
+        test = pixiv2Billfish()
+        # 监视模式从运行前的最大文件id开始检查，运行期间新增的文件不会被遗漏
+        last_id = None
+        if WATCH and PLAN:
+            logger.warning("PLAN 模式不支持 WATCH，处理完成后将退出")
+        elif WATCH:
+            last_id = test.db_tool.max_file_id()
+        test.main()
+        if last_id is not None and not test.cancelled:
+            test.watch(last_id)
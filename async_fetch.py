@@ -0,0 +1,175 @@
+# coding=utf8
+
+"""
+一个基于asyncio和aiohttp的请求引擎,
+所有请求共用一个保持连接(keep-alive)的连接池,
+由固定数量的协程从任务队列中取任务, 以此限制同时进行的请求数.
+读取任务与处理结果可能访问数据库, 分别在单独的线程中执行, 不阻塞事件循环.
+"""
+
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+import aiohttp
+
+from rate_limiter import LIMIT_STATUS, parse_retry_after
+
+
+class AsyncFetcher:
+
+    def __init__(self, limit, headers, proxy=None, timeout=5, retry_num=5, limiter=None, metrics=None,
+                 handler_threads=4):
+        """
+        初始化请求引擎
+        :param limit: 同时进行的最大请求数
+        :param headers: 请求头
+        :param proxy: http代理链接，None为不使用代理
+        :param timeout: 单次请求超时时间(秒)
+        :param retry_num: 重试次数
+        :param limiter: rate_limiter.RateLimiter，None为不限速
+        :param metrics: metrics.Metrics，None为不记录
+        :param handler_threads: 执行回调函数的线程数
+        """
+        self.limit = limit
+        self.headers = headers
+        self.proxy = proxy
+        self.timeout = timeout
+        self.retry_num = retry_num
+        self.limiter = limiter
+        self.metrics = metrics
+        self.handler_threads = handler_threads
+        # 正在进行的请求数
+        self.in_flight = 0
+        # 回调函数执行失败的任务数
+        self.fail_count = 0
+        # 事件循环已结束，读取任务的线程不再放入任务
+        self.closed = False
+        # 读取任务时的异常，在 run 中重新抛出
+        self.error = None
+
+    def run(self, jobs, handler, callback=None):
+        """
+        执行全部任务，直至任务迭代器耗尽
+        :param jobs: 可迭代对象，元素为 (url, arg)，url 为 None 时不发出请求，在单独的线程中迭代
+        :param handler: 回调函数 handler(arg, resp)，resp 为 (status, text) 或 None(请求失败)，在线程池中执行
+        :param callback: handler 执行失败时调用 callback(False, 异常)，与 ThreadPool 的回调函数相同，
+                         一个任务失败不影响其他任务，None为不调用
+        """
+        self.closed = False
+        self.error = None
+        asyncio.run(self._run(iter(jobs), handler, callback))
+        if self.error is not None:
+            raise self.error
+
+    async def _run(self, jobs, handler, callback):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(self.limit * 2)
+        producer = threading.Thread(target=self._produce, args=(loop, queue, jobs), name="async_jobs", daemon=True)
+        executor = concurrent.futures.ThreadPoolExecutor(self.handler_threads, thread_name_prefix="async_handler")
+        producer.start()
+        try:
+            connector = aiohttp.TCPConnector(limit=self.limit, ssl=False)
+            timeout = aiohttp.ClientTimeout(total=self.timeout)
+            async with aiohttp.ClientSession(headers=self.headers, connector=connector, timeout=timeout) as session:
+                await asyncio.gather(*[self._worker(session, queue, handler, executor, callback) for _ in range(self.limit)])
+        finally:
+            self.closed = True
+            await loop.run_in_executor(None, executor.shutdown)
+            await loop.run_in_executor(None, producer.join)
+
+    def _produce(self, loop, queue, jobs):
+        """
+        读取任务线程，迭代 jobs 并放入队列，结束后为每个协程放入一个结束标识 None
+        """
+        try:
+            for job in jobs:
+                if not self._put(loop, queue, job):
+                    return
+        except BaseException as e:
+            self.error = e
+        finally:
+            for _ in range(self.limit):
+                if not self._put(loop, queue, None):
+                    break
+
+    def _put(self, loop, queue, item):
+        """
+        放入队列，队列已满时等待
+        :return: 是否放入，事件循环已结束时为 False
+        """
+        if self.closed:
+            return False
+        future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while True:
+            try:
+                future.result(0.5)
+                return True
+            except concurrent.futures.TimeoutError:
+                if self.closed:
+                    future.cancel()
+                    return False
+
+    async def _worker(self, session, queue, handler, executor, callback):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await queue.get()
+            if job is None:
+                return
+            url, arg = job
+            try:
+                resp = await self.request(session, url) if url is not None else None
+                # 回调函数会解析并等待写入队列，在线程池中执行，写入队列已满时不影响其他请求
+                await loop.run_in_executor(executor, handler, arg, resp)
+            except Exception as e:
+                self.fail_count += 1
+                if callback is not None:
+                    callback(False, e)
+
+    async def request(self, session, url):
+        """
+        发出GET请求，失败时重试
+        :param session: aiohttp.ClientSession
+        :param url: 请求地址
+        :return: (status, text) or None
+        """
+        for _ in range(self.retry_num + 1):
+            if self.limiter is not None:
+                wait = self.limiter.reserve()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            self.in_flight += 1
+            start = time.monotonic()
+            if self.metrics is not None:
+                self.metrics.add("requests_in_flight", 1)
+            try:
+                async with session.get(url, proxy=self.proxy) as response:
+                    status, text = response.status, await response.text(encoding="utf8")
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            except Exception:
+                if self.metrics is not None:
+                    self.metrics.inc("http_responses_total", status="error")
+                if self.limiter is not None:
+                    self.limiter.on_limited()
+                else:
+                    await asyncio.sleep(0.5)
+                continue
+            finally:
+                self.in_flight -= 1
+                if self.metrics is not None:
+                    self.metrics.add("requests_in_flight", -1)
+                    self.metrics.observe("request_seconds", time.monotonic() - start)
+            if self.metrics is not None:
+                self.metrics.inc("http_responses_total", status=status)
+            # 请求过于频繁，退避后重试
+            if status in LIMIT_STATUS:
+                if self.limiter is not None:
+                    self.limiter.on_limited(retry_after)
+                else:
+                    await asyncio.sleep(0.5)
+                continue
+            if self.limiter is not None:
+                self.limiter.on_success()
+            return status, text
+        return None
@@ -0,0 +1,159 @@
+# coding=utf8
+
+"""
+按画师批量获取作品信息,
+/ajax/user/{uid}/profile/illusts 一次可查询同一画师的多个作品(ids[]), 返回标题、画师与标签,
+但不包括作品描述、收藏数与标签翻译, 需要这些内容的作品仍需逐个请求 /ajax/illust/{pid},
+标签翻译使用逐个请求的作品中已出现过的翻译, 含有未出现过的标签的作品默认也逐个请求.
+返回内容转换为与 /ajax/illust 相同的结构, 可直接交给 illust_parser 解析.
+"""
+
+import json
+import threading
+
+
+# 转换为 /ajax/illust 的返回结构
+def to_illust(work, translations=None):
+    """
+    将 profile/illusts 中的一个作品转换为 /ajax/illust 的返回结构
+    接口中没有的 bookmarkCount 记为 0，partial 标记为不完整的内容
+    :param work: works 中的一项
+    :param translations: {标签: 英文翻译 or None(没有翻译)}，None 为不添加翻译
+    :return: dict
+    """
+    tags = []
+    for tag in work.get("tags") or []:
+        item = {"tag": tag}
+        if translations and translations.get(tag):
+            item["translation"] = {"en": translations[tag]}
+        tags.append(item)
+    return {
+        "error": False,
+        "message": "",
+        "body": {
+            "illustId": str(work["id"]),
+            "illustTitle": work.get("title", ""),
+            "userId": str(work.get("userId", "")),
+            "userName": work.get("userName", ""),
+            "bookmarkCount": 0,
+            "illustComment": work.get("description") or "",
+            "tags": {"tags": tags},
+            "partial": True,
+        },
+    }
+
+
+class BatchFetcher:
+
+    def __init__(self, request, user_url, batch_size=48, metrics=None, lossy=False):
+        """
+        :param request: 请求函数 request(url)，返回 (status_code, text) or None (请求失败)
+        :param user_url: 用户接口地址，如 https://www.pixiv.net/ajax/user/
+        :param batch_size: 每次请求的最大作品数
+        :param metrics: Metrics，None为不记录
+        :param lossy: 是否保留含有未知翻译标签的作品，False 时不返回这些作品，由调用者逐个获取
+        """
+        self.request = request
+        self.user_url = user_url
+        self.batch_size = batch_size
+        self.metrics = metrics
+        self.lossy = lossy
+        self.lock = threading.Lock()
+        # uid -> {pid, ...} 已查询过的画师作品
+        self.works = {}
+        # uid -> threading.Event 正在查询的画师，查询完成时触发
+        self.loading = {}
+        # 标签 -> 英文翻译 or None(没有翻译)，由逐个获取的作品得到
+        self.translations = {}
+        # 批量请求次数、获取到的作品数与因标签翻译未知而未返回的作品数
+        self.batch_count = 0
+        self.work_count = 0
+        self.unknown_count = 0
+
+    def learn(self, json_data):
+        """
+        记录 /ajax/illust 返回内容中的标签翻译，没有翻译的标签也记录，之后的批量结果中可直接使用
+        :param json_data: /ajax/illust 的返回内容
+        """
+        tags = json_data["body"].get("tags", {}).get("tags", [])
+        with self.lock:
+            for i in tags:
+                translation = (i.get("translation") or {}).get("en")
+                if translation or i["tag"] not in self.translations:
+                    self.translations[i["tag"]] = translation
+
+    def user_works(self, uid, json_data=None):
+        """
+        获取画师的全部作品id，同一画师只查询一次，其他线程正在查询时等待其结果
+        优先使用 /ajax/illust 返回内容中的 userIllusts，没有时请求 /ajax/user/{uid}/profile/all
+        :param uid: 画师id
+        :param json_data: 该画师某一作品的 /ajax/illust 返回内容
+        :return: {pid, ...} 请求失败时为空
+        """
+        with self.lock:
+            if uid in self.works:
+                return self.works[uid]
+            event = self.loading.get(uid)
+            if event is None:
+                self.loading[uid] = threading.Event()
+        if event is not None:
+            event.wait()
+            with self.lock:
+                return self.works.get(uid, set())
+        works = set()
+        try:
+            user_illusts = json_data["body"].get("userIllusts") if json_data is not None else None
+            if user_illusts:
+                works.update(str(i) for i in user_illusts)
+            else:
+                resp = self.request(f"{self.user_url}{uid}/profile/all")
+                if resp is not None and resp[0] == 200:
+                    body = json.loads(resp[1]).get("body") or {}
+                    # 没有作品时为 []，否则为 {pid: null}
+                    for key in ("illusts", "manga"):
+                        works.update(str(i) for i in body.get(key) or ())
+        finally:
+            with self.lock:
+                self.works[uid] = works
+                self.loading.pop(uid).set()
+        return works
+
+    def fetch(self, uid, pids):
+        """
+        批量获取同一画师的作品，每 batch_size 个作品请求一次
+        :param uid: 画师id
+        :param pids: 作品id列表
+        :return: {pid: (200, text)} text 为 /ajax/illust 结构的 JSON，
+                 接口未返回的作品与(lossy 为 False 时)含有未知翻译标签的作品不包括在内
+        """
+        result = {}
+        unknown = 0
+        for i in range(0, len(pids), self.batch_size):
+            group = [str(pid) for pid in pids[i:i + self.batch_size]]
+            url = (f"{self.user_url}{uid}/profile/illusts?" + "&".join(f"ids[]={pid}" for pid in group)
+                   + "&work_category=illustManga&is_first_page=0")
+            resp = self.request(url)
+            with self.lock:
+                self.batch_count += 1
+            if self.metrics is not None:
+                self.metrics.inc("batch_requests_total")
+            if resp is None or resp[0] != 200:
+                continue
+            data = json.loads(resp[1])
+            if data.get("error"):
+                continue
+            works = (data.get("body") or {}).get("works") or {}
+            wanted = set(group)
+            for pid, work in works.items():
+                if str(pid) not in wanted:
+                    continue
+                if not self.lossy and any(tag not in self.translations for tag in work.get("tags") or ()):
+                    unknown += 1
+                    continue
+                result[str(pid)] = (200, json.dumps(to_illust(work, self.translations), ensure_ascii=False))
+        with self.lock:
+            self.work_count += len(result)
+            self.unknown_count += unknown
+        if self.metrics is not None:
+            self.metrics.inc("batch_works_total", len(result))
+        return result
@@ -0,0 +1,395 @@
+# coding=utf8
+
+"""
+性能测试,
+在本地启动一个模拟 pixiv /ajax/illust/{pid} 与 /ajax/user/{uid}/profile/* 的http服务, 可设置延迟/404比例/429突发/返回内容大小,
+以 billfish.db / billfish_v2.db 的表结构生成指定文件数的测试数据库,
+完整运行一次 pixiv2Billfish.main 并输出 文件/秒 请求/秒 提交耗时 内存峰值.
+
+e.g.
+python benchmark.py run --files 10k
+python benchmark.py run --files 100k --template billfish.db --latency 0.1 --set FETCH_Thread=32
+python benchmark.py run --files 100k --set FETCH_ENGINE='"async"' ASYNC_LIMIT=128
+python benchmark.py run --files 10k --set FETCH_ENGINE='"batch"' WRITE_NOTE=0
+python benchmark.py gen --files 1m --out bench_1m.db
+python benchmark.py serve --port 18080 --not-found 0.1
+"""
+
+import argparse
+import ast
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.request import urlopen
+
+ROOT_PATH = os.path.split(os.path.abspath(__file__))[0]
+BENCH_PATH = os.path.join(ROOT_PATH, "bench")
+# 测试数据库中的pid从此开始递增
+PID_BASE = 40000000
+
+
+# 解析文件数
+def parse_num(value):
+    """
+    支持 10k 1m 形式
+    :param value: 字符串
+    :return: int
+    """
+    value = value.lower()
+    for suffix, scale in (("k", 1000), ("m", 1000000)):
+        if value.endswith(suffix):
+            return int(float(value[:-1]) * scale)
+    return int(value)
+
+
+class stub_handler(BaseHTTPRequestHandler):
+    """
+    模拟 /ajax/illust/{pid}，作品内容由pid决定，多次请求同一作品返回相同内容
+    以及 /ajax/user/{uid}/profile/all 与 /ajax/user/{uid}/profile/illusts?ids[]=，画师为 pid % artist_num
+    """
+    protocol_version = "HTTP/1.1"
+    # 由 serve 设置
+    options = None
+    lock = threading.Lock()
+    request_num = 0
+    status = {}
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/stats":
+            with self.lock:
+                stats = {"requests": self.request_num, "status": dict(self.status)}
+            return self.send(200, stats)
+        options = self.options
+        with self.lock:
+            cls = type(self)
+            cls.request_num += 1
+            num = cls.request_num
+        if options.latency:
+            time.sleep(options.latency * random.uniform(0.5, 1.5))
+        # 每 burst_every 个请求之后的 burst_size 个请求返回429
+        if options.burst_every and num % options.burst_every < options.burst_size:
+            return self.send(429, {"error": True, "message": "too many requests", "body": []},
+                             {"Retry-After": str(options.retry_after)})
+        if self.path.startswith("/ajax/user/"):
+            return self.user_works(options)
+        pid = self.path.rstrip("/").split("/")[-1].split("?")[0]
+        rand = random.Random(pid)
+        if not pid.isdigit() or rand.random() < options.not_found:
+            return self.send(404, {"error": True, "message": "該当作品は削除されたか、存在しない作品IDです。", "body": []})
+        self.send(200, {"error": False, "message": "", "body": self.build_body(int(pid), rand, options)})
+
+    def user_works(self, options):
+        """
+        profile/all 返回 PID_BASE 至 options.pid_max 间属于该画师的全部pid
+        profile/illusts 返回 ids[] 中属于该画师且未被删除的作品，不包括描述与标签翻译
+        """
+        path, _, query = self.path.partition("?")
+        parts = path.strip("/").split("/")
+        if len(parts) != 5 or not parts[2].isdigit():
+            return self.send(404, {"error": True, "message": "not found", "body": []})
+        uid = int(parts[2])
+        if parts[4] == "all":
+            first = PID_BASE + (uid - PID_BASE) % options.artist_num
+            illusts = {str(pid): None for pid in range(first, options.pid_max + 1, options.artist_num)}
+            return self.send(200, {"error": False, "message": "", "body": {"illusts": illusts, "manga": []}})
+        works = {}
+        for item in query.split("&"):
+            key, _, pid = item.partition("=")
+            if key not in ("ids[]", "ids%5B%5D") or not pid.isdigit() or int(pid) % options.artist_num != uid:
+                continue
+            rand = random.Random(pid)
+            if rand.random() < options.not_found:
+                continue
+            body = self.build_body(int(pid), rand, options)
+            works[pid] = {"id": pid, "title": body["illustTitle"], "userId": body["userId"],
+                          "userName": body["userName"], "description": "",
+                          "tags": [i["tag"] for i in body["tags"]["tags"]]}
+        self.send(200, {"error": False, "message": "", "body": {"works": works, "extraData": {}}})
+
+    @staticmethod
+    def build_body(pid, rand, options):
+        """
+        生成作品信息，标签从 options.tag_num 个标签中选取
+        """
+        artist = pid % options.artist_num
+        tags = []
+        for i in rand.sample(range(options.tag_num), min(8, options.tag_num)):
+            tag = {"tag": f"タグ{i}"}
+            if i % 2:
+                tag["translation"] = {"en": f"tag{i}"}
+            tags.append(tag)
+        comment = ""
+        if options.payload:
+            line = f"comment of {pid}<br /><a href=\"/jump.php?https://example.com/{pid}\" target=\"_blank\">link</a><br />"
+            comment = (line * (options.payload // len(line) + 1))[:options.payload]
+        return {
+            "illustId": str(pid),
+            "illustTitle": f"title {pid}",
+            "userName": f"artist{artist}@fanbox",
+            "userId": str(artist),
+            "bookmarkCount": rand.randint(0, 10000),
+            "illustComment": comment,
+            "tags": {"tags": tags},
+        }
+
+    def send(self, code, obj, headers=None):
+        data = json.dumps(obj).encode("utf8")
+        with self.lock:
+            if self.path != "/stats":
+                self.status[code] = self.status.get(code, 0) + 1
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+# 启动模拟服务
+def serve(options):
+    """
+    在当前进程中启动模拟服务，直至进程结束
+    :param options: argparse.Namespace
+    """
+    if not options.pid_max:
+        # 按文件数估算测试数据库中最大的pid
+        options.pid_max = PID_BASE + 50 * getattr(options, "files", 10000)
+    stub_handler.options = options
+    server = ThreadingHTTPServer(("127.0.0.1", options.port), stub_handler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+# 读取模拟服务的统计
+def get_stats(port):
+    with urlopen(f"http://127.0.0.1:{port}/stats", timeout=5) as resp:
+        return json.loads(resp.read())
+
+
+# 生成测试数据库
+def generate_db(path, files, template, pages=4, unknown=0.02, done=0.0, seed=1):
+    """
+    按模板数据库的表结构生成测试数据库
+    :param path: 输出路径
+    :param files: 文件数
+    :param template: 模板数据库，billfish.db 或 billfish_v2.db
+    :param pages: 多P作品的最大页数
+    :param unknown: 无法识别的文件比例
+    :param done: 已有标签与备注的文件比例，用于测试增量运行
+    :param seed: 随机种子
+    """
+    if not os.path.isfile(template):
+        # 默认使用程序目录下的示例数据库
+        template = os.path.join(ROOT_PATH, template)
+    if not os.path.isfile(template):
+        raise FileNotFoundError(template)
+    # 先写入临时文件，生成完毕再改名，中断时不会留下不完整的数据库
+    temp_path = path + ".tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    src = sqlite3.connect(template)
+    schema = src.execute(
+        "SELECT sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+        "ORDER BY type = 'table' DESC").fetchall()
+    is_v3_db = bool(src.execute("SELECT 1 FROM sqlite_master WHERE name = 'bf_tag_v2'").fetchall())
+    src.close()
+
+    rand = random.Random(seed)
+    conn = sqlite3.connect(temp_path)
+    for sql, in schema:
+        conn.execute(sql)
+    groups = []
+    num = 0
+    pid = PID_BASE
+    while num < files:
+        pid += rand.randint(1, 50)
+        if rand.random() < unknown:
+            groups.append([f"wallpaper_{pid}.png"])
+        else:
+            groups.append([f"{pid}_p{page}.{rand.choice(('jpg', 'png'))}"
+                           for page in range(rand.randint(1, pages) if rand.random() < 0.3 else 1)])
+        num += len(groups[-1])
+    # 与 Billfish 一样，文件id按导入顺序而非pid排序，同一作品的多P一起导入
+    rand.shuffle(groups)
+    rows = [name for group in groups for name in group][:files]
+    conn.execute("BEGIN")
+    conn.executemany("INSERT INTO bf_file (id, name, pid) VALUES (?,?,1)", enumerate(rows, 1))
+    if done:
+        conn.execute("INSERT INTO {} (id, name) VALUES (1, 'benchmark')".format("bf_tag_v2" if is_v3_db else "bf_tag"))
+        done_ids = range(1, int(files * done) + 1)
+        conn.executemany("INSERT INTO bf_tag_join_file (file_id, tag_id) VALUES (?,1)", ((i,) for i in done_ids))
+        conn.executemany("INSERT INTO bf_material_userdata (file_id, note) VALUES (?,'benchmark')",
+                         ((i,) for i in done_ids))
+    conn.execute("COMMIT")
+    conn.close()
+    os.replace(temp_path, path)
+
+
+# 内存峰值
+def peak_rss():
+    """
+    :return: 本进程的内存峰值(MB) or None
+    """
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS 为字节，Linux 为KB
+        return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return round(psutil.Process().memory_info().peak_wset / 1024 / 1024, 1)
+    except (ImportError, AttributeError):
+        return None
+
+
+# 百分位
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+# 完整运行一次
+def run(options):
+    """
+    生成(或复用)测试数据库，启动模拟服务，运行 pixiv2Billfish.main 并输出结果
+    :param options: argparse.Namespace
+    """
+    os.makedirs(BENCH_PATH, exist_ok=True)
+    name = os.path.splitext(os.path.basename(options.template))[0]
+    source = os.path.join(BENCH_PATH, f"{name}_{options.files}_{options.done}.db")
+    if not os.path.exists(source):
+        print(f"<gen> {source}")
+        generate_db(source, options.files, options.template, done=options.done)
+    # 每次运行都从相同的数据库开始
+    db_path = os.path.join(BENCH_PATH, "run.db")
+    # 上次运行被中断时可能残留 WAL 文件
+    for suffix in ("-wal", "-shm", "-journal"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    shutil.copy(source, db_path)
+
+    server = multiprocessing.Process(target=serve, args=(options,), daemon=True)
+    server.start()
+    for _ in range(50):
+        try:
+            get_stats(options.port)
+            break
+        except OSError:
+            time.sleep(0.1)
+
+    sys.path.insert(0, ROOT_PATH)
+    import Pixiv2Billfish as P
+    from loguru import logger
+    from thread_pool import ThreadPool
+    if not options.log:
+        # 只去掉控制台输出，保留日志文件
+        logger.remove(0)
+
+    P.DB_PATH = db_path
+    P.temp_url = f"http://127.0.0.1:{options.port}/ajax/illust/"
+    P.user_url = f"http://127.0.0.1:{options.port}/ajax/user/"
+    P.CACHE_PATH = ""
+    P.RESUME = 0
+    for item in options.set:
+        key, value = item.split("=", 1)
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+        setattr(P, key, value)
+    # 线程池与连接池在导入时按默认值创建，按设置重新创建
+    P.FETCH_TOOL = ThreadPool(P.FETCH_Thread, P.FETCH_QUEUE_SIZE)
+    for prefix in ("http://", "https://"):
+        P.session.mount(prefix, P.requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=P.FETCH_Thread))
+
+    start = time.monotonic()
+    tool = P.pixiv2Billfish()
+    tool.main()
+    elapsed = time.monotonic() - start
+    stats = get_stats(options.port)
+    server.terminate()
+
+    # PLAN = "write" 时不写入数据库，没有写入线程
+    commit_times = tool.db_writer.commit_times if getattr(tool, "db_writer", None) is not None else []
+    result = {
+        "db": os.path.basename(source),
+        "files": tool.file_num,
+        "seconds": round(elapsed, 2),
+        "files_per_sec": round(tool.file_num / elapsed, 1),
+        "requests": stats["requests"],
+        "requests_per_sec": round(stats["requests"] / elapsed, 1),
+        "status": stats["status"],
+        "commits": len(commit_times),
+        "commit_ms_avg": round(sum(commit_times) / len(commit_times) * 1000, 1) if commit_times else 0.0,
+        "commit_ms_p95": round(percentile(commit_times, 0.95) * 1000, 1),
+        "commit_ms_max": round(max(commit_times, default=0.0) * 1000, 1),
+        "peak_rss_mb": peak_rss(),
+        "set": options.set,
+    }
+    print(json.dumps(result, ensure_ascii=False))
+    if options.output:
+        with open(options.output, "a", encoding="utf8") as f:
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pixiv2Billfish 性能测试")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def add_server_options(p):
+        p.add_argument("--port", type=int, default=18080)
+        p.add_argument("--latency", type=float, default=0.0, help="每个请求的平均延迟(秒)")
+        p.add_argument("--not-found", type=float, default=0.05, help="返回404的作品比例")
+        p.add_argument("--burst-every", type=int, default=0, help="每多少个请求出现一次429突发，0为不出现")
+        p.add_argument("--burst-size", type=int, default=10, help="每次突发返回429的请求数")
+        p.add_argument("--retry-after", type=int, default=1, help="429 的 Retry-After(秒)")
+        p.add_argument("--payload", type=int, default=200, help="作品描述的长度(字符)")
+        p.add_argument("--tag-num", type=int, default=2000, help="标签总数")
+        p.add_argument("--artist-num", type=int, default=500, help="画师总数")
+        p.add_argument("--pid-max", type=int, default=0, help="profile/all 返回的最大pid，0为按文件数估算")
+
+    p = sub.add_parser("serve", help="只启动模拟服务")
+    add_server_options(p)
+
+    p = sub.add_parser("gen", help="只生成测试数据库")
+    p.add_argument("--files", type=parse_num, default="10k")
+    p.add_argument("--template", default="billfish_v2.db")
+    p.add_argument("--done", type=float, default=0.0, help="已有标签与备注的文件比例")
+    p.add_argument("--out", required=True)
+
+    p = sub.add_parser("run", help="生成数据库并完整运行一次")
+    add_server_options(p)
+    p.add_argument("--files", type=parse_num, default="10k", help="文件数，如 10k 100k 1m")
+    p.add_argument("--template", default="billfish_v2.db", help="表结构模板 billfish.db 或 billfish_v2.db")
+    p.add_argument("--done", type=float, default=0.0, help="已有标签与备注的文件比例")
+    p.add_argument("--set", nargs="*", default=[], help="覆盖 Pixiv2Billfish 中的设置，如 FETCH_Thread=32")
+    p.add_argument("--log", action="store_true", help="在控制台输出日志")
+    p.add_argument("--output", help="将结果追加写入该文件(JSONL)")
+
+    options = parser.parse_args()
+    if options.command == "serve":
+        serve(options)
+    elif options.command == "gen":
+        generate_db(options.out, options.files, options.template, done=options.done)
+    else:
+        run(options)
+
+
+if __name__ == '__main__':
+    main()
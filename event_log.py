@@ -0,0 +1,41 @@
+# coding=utf8
+
+"""
+紧凑的事件记录,
+每个作品的处理结果写为一行 JSON (JSON Lines),
+用于在不逐条输出日志的情况下保留每个文件的处理结果.
+"""
+
+import json
+import threading
+import time
+
+
+class EventLog:
+
+    def __init__(self, path):
+        """
+        打开(追加)事件记录文件
+        :param path: 文件路径
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding="utf8", buffering=1 << 16)
+        self.count = 0
+
+    def write(self, event, **fields):
+        """
+        写入一条事件
+        :param event: 事件类型，如 "written" "skip" "404"
+        :param fields: 其他字段，如 pid=114514, files=2
+        """
+        record = {"t": round(time.time(), 3), "event": event}
+        record.update(fields)
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
@@ -0,0 +1,141 @@
+# coding=utf8
+
+"""
+由 /ajax/illust 的返回内容生成标签与备注,
+只做解析不做请求与写入, 可在解析进程中批量执行.
+"""
+
+import json
+import re
+
+# 预编译备注中用到的正则
+BR_RE = re.compile("<br />+")
+HTML_RE = re.compile(r"<(\S*?)[^>]*>.*?|<.*? /> ")
+JUMP_RE = re.compile(r"\[url\]/jump.php.*\[/url\]\r\n")
+
+
+# 读取作品信息
+def load_illust(resp):
+    """
+    将返回内容转换为作品信息，404 的作品标记 status = 404
+    :params resp: (status_code, text) or None (请求失败)
+    :return: json_data or None
+    """
+    if resp is None:
+        return None
+    status_code, text = resp
+    json_data = json.loads(text)
+    if status_code == 404:
+        json_data["status"] = 404
+    return json_data
+
+
+# 处理画师名称
+def get_artist_name(artist, full_width=True):
+    """
+    去除画师名称中 @ 之后的内容（一般为宣传信息）
+    :params artist: userName
+    :params full_width: 是否同时处理全角＠
+    :return: artist
+    """
+    if artist.rfind('@') != -1 and 2 <= artist.rfind('@') <= len(artist) - 3:
+        return artist[0:artist.rfind('@')]
+    elif full_width and artist.rfind('＠') != -1 and 2 <= artist.rfind('＠') <= len(artist) - 3:
+        return artist[0:artist.rfind('＠')]
+    return artist
+
+
+# 由作品信息生成标签
+def build_tags(json_data):
+    """
+    由get_illust 返回的作品信息生成标签
+    :params json_data: get_illust 的返回值
+    :return: [tag1,tag2...] or []
+    """
+    if json_data is None:
+        return []
+    elif json_data.get("status") == 404:
+        return ['Error:404']
+
+    if not json_data["error"]:
+        tags = json_data["body"]["tags"]["tags"]
+        # 加入画师名称
+        artist = get_artist_name(json_data["body"]["userName"])
+        # 为方便添加父标签，Artist 仍会处理成 ‘Artist:ID’ 形式，将在处理完毕时统一去除 ‘Artist:’
+        tag_list = ["Artist:" + artist]
+
+        for i in tags:
+            if "translation" in i:
+                tag_list.append(i["translation"]["en"])
+            tag_list.append(i["tag"])
+        # 去重并保持顺序
+        return list(dict.fromkeys(tag_list))
+    else:
+        return []
+
+
+# 由作品信息生成备注
+def build_note(json_data):
+    """
+    由get_illust 返回的作品信息生成备注 illustTitle userName userId illustComment
+    :params json_data: get_illust 的返回值
+    :return: "illustTitle userName userId  illustComment" or “”
+    """
+    if json_data is None:
+        return ""
+    elif json_data.get("status") == 404:
+        return "Error:404"
+
+    if not json_data["error"]:
+        body = json_data["body"]
+        # 添加标题
+        note = "Title:" + body["illustTitle"] + "\r\n"
+        # 添加作者
+        artist = get_artist_name(body["userName"], full_width=False)
+        note += "Artist:" + artist + "\r\n"
+        # 添加UID
+        note += "UID:" + body["userId"] + "\r\n"
+
+        # 添加Bookmark
+        note += "Bookmark:" + str(body["bookmarkCount"]) + "\r\n"
+
+        # 添加描述
+        if body["illustComment"] != "":
+            note += "Comment:\r\n" + body["illustComment"]
+            # 替换描述中的<br /> 为 \n <a href>替换为[url]href[/url]
+            note = BR_RE.sub("\r\n", note).replace("<a href=\"", "[url]").replace(
+                "\" target=\"_blank\">", "[/url]\r\n")
+            # 删除描述中其他HTML标签
+            note = HTML_RE.sub("", note)
+            # 删除转跳提示链接
+            note = JUMP_RE.sub("", note)
+        else:
+            note += "No Comment\r\n"
+        note = note.replace("'", "''")
+        return note
+    else:
+        return ""
+
+
+# 批量解析
+def parse_batch(batch):
+    """
+    批量生成标签与备注，供解析进程调用
+    :params batch: [(resp, write_tag, write_note), ...]
+    :return: [(tag_list, note, error, message), ...]
+             error 为返回内容中的 error 字段，message 为错误信息
+             无法解析的作品(如返回内容不是JSON)为 (None, None, True, 异常信息)，不影响同一批的其他作品
+    """
+    result = []
+    for resp, write_tag, write_note in batch:
+        try:
+            json_data = load_illust(resp)
+            if json_data is None:
+                result.append(([], "", True, None))
+                continue
+            result.append((build_tags(json_data) if write_tag else [],
+                           build_note(json_data) if write_note else "",
+                           bool(json_data.get("error")), json_data.get("message")))
+        except Exception as e:
+            result.append((None, None, True, "{!r}".format(e)))
+    return result
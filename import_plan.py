@@ -0,0 +1,105 @@
+# coding=utf8
+
+"""
+导入计划,
+将要写入数据库的 标签/备注 按作品记录为 JSON Lines 文件, 不修改数据库,
+标签以名称记录, 写入时再分配id, 之后可在一个事务中一次写入.
+"""
+
+import json
+import threading
+import time
+
+# 计划文件格式版本
+PLAN_VERSION = 1
+
+
+class ImportPlan:
+
+    def __init__(self, path, library, is_v3_db):
+        """
+        创建计划文件，已存在时覆盖
+        :param path: 计划文件路径
+        :param library: 素材库标识，一般为数据库的绝对路径
+        :param is_v3_db: 是否为3.0版本的新数据库
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "w", encoding="utf8", buffering=1 << 16)
+        # 计划中的 标签名、文件标签数 与 写入备注的文件
+        self.tag_names = set()
+        self.join_count = 0
+        self.note_files = []
+        self.write({"plan": PLAN_VERSION, "library": library, "v3": bool(is_v3_db), "time": round(time.time())})
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+        with self.lock:
+            self.file.write(line)
+
+    def put_tags(self, pid, file_ids, tag_list):
+        """
+        记录该作品的文件需要写入的标签
+        """
+        self.write({"pid": pid, "files": list(file_ids), "tags": list(tag_list)})
+        with self.lock:
+            self.tag_names.update(tag_list)
+            self.join_count += len(file_ids) * len(tag_list)
+
+    def put_note(self, pid, file_ids, note, origin):
+        """
+        记录该作品的文件需要写入的备注
+        """
+        self.write({"pid": pid, "files": list(file_ids), "note": note, "origin": origin})
+        with self.lock:
+            self.note_files.extend(file_ids)
+
+    def close(self, summary):
+        """
+        写入统计信息并关闭计划文件，summary 为文件的最后一行
+        :param summary: dict，complete 为计划是否完整(程序未被中断)
+        """
+        self.write({"summary": summary})
+        with self.lock:
+            self.file.close()
+
+
+def read_summary(path):
+    """
+    读取计划文件最后一行的统计信息
+    :param path: 计划文件路径
+    :return: dict or None (没有统计信息，如程序在生成计划时崩溃)
+    """
+    last = b""
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                last = line
+    try:
+        record = json.loads(last)
+    except ValueError:
+        return None
+    return record.get("summary") if isinstance(record, dict) else None
+
+
+def read_plan(path):
+    """
+    读取计划文件
+    :param path: 计划文件路径
+    :return: (header, summary, 生成器 record) header 为计划文件的第一行，summary 见 read_summary
+    """
+    summary = read_summary(path)
+    f = open(path, encoding="utf8")
+    header = json.loads(f.readline() or "{}")
+    if header.get("plan") != PLAN_VERSION:
+        f.close()
+        raise ValueError(f"{path} 不是有效的计划文件")
+
+    def records():
+        with f:
+            for line in f:
+                record = json.loads(line)
+                if "pid" in record:
+                    yield record
+
+    return header, summary, records()
@@ -0,0 +1,85 @@
+# coding=utf8
+
+"""
+基于sqlite的pixiv作品信息缓存,
+以pid为键保存 /ajax/illust 的原始返回内容(包括404),
+支持有效期(TTL)与按最近使用时间(LRU)淘汰.
+"""
+
+import sqlite3
+import threading
+import time
+
+
+class MetaCache:
+
+    def __init__(self, path, ttl=0, max_items=0):
+        """
+        打开(或创建)缓存文件
+        :param path: 缓存文件路径
+        :param ttl: 缓存有效期(秒)，0为永不过期
+        :param max_items: 缓存最大条数，0为不限制
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_items = max_items
+        self.lock = threading.Lock()
+        # 命中/未命中计数
+        self.hit = 0
+        self.miss = 0
+        # 所有线程共用一个连接，由 lock 保护
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS illust ("
+            "pid TEXT PRIMARY KEY, status INTEGER, body TEXT, fetched_at REAL, accessed_at REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS illust_accessed_idx ON illust(accessed_at)")
+        self.count = self.conn.execute("SELECT count(*) FROM illust").fetchone()[0]
+
+    def get(self, pid):
+        """
+        读取缓存
+        :param pid: pixiv插画id
+        :return: (status, body) or None (未缓存或已过期)
+        """
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT status, body, fetched_at FROM illust WHERE pid = ?", (str(pid),)).fetchone()
+            if row is None or (self.ttl and now - row[2] > self.ttl):
+                self.miss += 1
+                return None
+            self.conn.execute("UPDATE illust SET accessed_at = ? WHERE pid = ?", (now, str(pid)))
+            self.hit += 1
+            return row[0], row[1]
+
+    def put(self, pid, status, body):
+        """
+        写入缓存，超出最大条数时淘汰最久未使用的条目
+        :param pid: pixiv插画id
+        :param status: http状态码
+        :param body: 原始返回内容
+        """
+        now = time.time()
+        with self.lock:
+            exist = self.conn.execute("SELECT 1 FROM illust WHERE pid = ?", (str(pid),)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO illust (pid, status, body, fetched_at, accessed_at) VALUES (?,?,?,?,?)",
+                (str(pid), status, body, now, now))
+            if not exist:
+                self.count += 1
+            if self.max_items and self.count > self.max_items:
+                # 一次多淘汰一部分，避免每次写入都触发淘汰
+                evict = self.count - int(self.max_items * 0.9)
+                cursor = self.conn.execute(
+                    "DELETE FROM illust WHERE pid IN "
+                    "(SELECT pid FROM illust ORDER BY accessed_at LIMIT ?)", (evict,))
+                self.count -= cursor.rowcount
+
+    def close(self):
+        """
+        关闭缓存
+        """
+        with self.lock:
+            self.conn.close()
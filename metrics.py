@@ -0,0 +1,267 @@
+# coding=utf8
+
+"""
+运行指标,
+计数器/仪表/直方图 由各线程直接更新,
+可通过 http 以 Prometheus 文本格式(/metrics)或 JSON(/metrics.json)读取,
+也可定时将 JSON 快照追加写入文件.
+"""
+
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# 默认的直方图分桶(秒)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def format_key(name, labels):
+    """
+    :return: name{k="v",...}
+    """
+    if not labels:
+        return name
+    return name + "{" + ",".join('{}="{}"'.format(k, v) for k, v in labels) + "}"
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        按分桶估算分位数，返回所在分桶的上界
+        """
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            if total >= target:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+
+    def __init__(self, prefix="pixiv2billfish"):
+        """
+        :param prefix: 指标名前缀
+        """
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        # (name, labels) -> value
+        self.counters = {}
+        self.gauges = {}
+        # name -> Histogram
+        self.histograms = {}
+        # name -> 读取时调用的函数
+        self.funcs = {}
+        # 上次快照的时间与写入文件数，用于计算区间速率
+        self.last = (self.start, 0)
+
+    def inc(self, name, value=1, **labels):
+        """
+        计数器增加
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add(self, name, value, **labels):
+        """
+        仪表增减，如正在进行的请求数
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """
+        仪表设为 value
+        """
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS):
+        """
+        直方图记录一个值
+        """
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+
+    def get(self, name, **labels):
+        """
+        读取计数器的值，未指定的标签会被合计
+        :return: value
+        """
+        labels = set(labels.items())
+        with self.lock:
+            return sum(v for (n, l), v in self.counters.items() if n == name and labels <= set(l))
+
+    def gauge_func(self, name, func):
+        """
+        注册读取时才计算的仪表，如队列长度
+        :param func: 无参数函数，返回数值
+        """
+        with self.lock:
+            self.funcs[name] = func
+
+    def read_funcs(self):
+        values = {}
+        for name, func in list(self.funcs.items()):
+            try:
+                values[name] = func()
+            except Exception:
+                pass
+        return values
+
+    def render(self):
+        """
+        :return: Prometheus 文本格式
+        """
+        funcs = self.read_funcs()
+        lines = []
+        with self.lock:
+            for kind, items in (("counter", self.counters), ("gauge", self.gauges)):
+                names = set()
+                for (name, labels), value in sorted(items.items()):
+                    full = f"{self.prefix}_{name}"
+                    if name not in names:
+                        names.add(name)
+                        lines.append(f"# TYPE {full} {kind}")
+                    lines.append(f"{format_key(full, labels)} {value}")
+            for name, histogram in sorted(self.histograms.items()):
+                full = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {full} histogram")
+                total = 0
+                for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    total += count
+                    lines.append(f'{full}_bucket{{le="{bound}"}} {total}')
+                lines.append(f"{full}_sum {histogram.sum}")
+                lines.append(f"{full}_count {histogram.count}")
+        for name, value in sorted(funcs.items()):
+            full = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {full} gauge")
+            lines.append(f"{full} {value}")
+        lines.append(f"# TYPE {self.prefix}_uptime_seconds gauge")
+        lines.append(f"{self.prefix}_uptime_seconds {round(time.monotonic() - self.start, 3)}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """
+        :return: 当前指标的 dict，files_per_sec 为距上次快照的写入速率
+        """
+        funcs = self.read_funcs()
+        now = time.monotonic()
+        with self.lock:
+            data = {
+                "time": round(time.time(), 3),
+                "elapsed": round(now - self.start, 3),
+            }
+            for (name, labels), value in sorted(self.counters.items()):
+                data[format_key(name, labels)] = value
+            for (name, labels), value in sorted(self.gauges.items()):
+                data[format_key(name, labels)] = value
+            for name, histogram in sorted(self.histograms.items()):
+                data[name] = {
+                    "count": histogram.count,
+                    "avg": round(histogram.sum / histogram.count, 4) if histogram.count else 0.0,
+                    "p50": histogram.quantile(0.5),
+                    "p95": histogram.quantile(0.95),
+                }
+            files = sum(v for (name, _), v in self.counters.items() if name == "files_written_total")
+            last_time, last_files = self.last
+            self.last = (now, files)
+        data.update(funcs)
+        data["files_per_sec"] = round((files - last_files) / max(now - last_time, 1e-6), 1)
+        hit, miss = data.get("cache_hits", 0), data.get("cache_misses", 0)
+        if hit + miss:
+            data["cache_hit_ratio"] = round(hit / (hit + miss), 4)
+        return data
+
+
+class MetricsServer:
+    """
+    在后台线程中提供 /metrics (Prometheus) 与 /metrics.json
+    """
+
+    def __init__(self, metrics, port, host="127.0.0.1"):
+        class handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.startswith("/metrics.json"):
+                    body, content_type = json.dumps(metrics.snapshot()), "application/json"
+                elif self.path.startswith("/metrics"):
+                    body, content_type = metrics.render(), "text/plain; version=0.0.4"
+                else:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                data = body.encode("utf8")
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics_server", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsWriter:
+    """
+    每隔 interval 秒将快照追加写入 path (JSON Lines)
+    """
+
+    def __init__(self, metrics, path, interval):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="metrics_writer", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.write()
+
+    def write(self):
+        with open(self.path, "a", encoding="utf8") as f:
+            f.write(json.dumps(self.metrics.snapshot(), ensure_ascii=False) + "\n")
+
+    def close(self):
+        """
+        停止并写入最后一次快照
+        """
+        self.stop_event.set()
+        self.thread.join()
+        self.write()
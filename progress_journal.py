@@ -0,0 +1,87 @@
+# coding=utf8
+
+"""
+基于sqlite的进度记录,
+按素材库记录已写入 标签/备注 的文件与作品(pid),
+中断后重新运行时跳过已完成的部分.
+"""
+
+import sqlite3
+import threading
+
+
+class ProgressJournal:
+
+    def __init__(self, path, library):
+        """
+        打开(或创建)进度记录
+        :param path: 进度记录文件路径
+        :param library: 素材库标识，一般为数据库的绝对路径
+        """
+        self.path = path
+        self.library = library
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS file_done ("
+            "library TEXT, kind TEXT, file_id INTEGER, PRIMARY KEY (library, kind, file_id)) WITHOUT ROWID")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS pid_done ("
+            "library TEXT, kind TEXT, pid TEXT, PRIMARY KEY (library, kind, pid)) WITHOUT ROWID")
+
+    def done(self, kind, file_ids):
+        """
+        查询已完成的文件
+        :param kind: "tag" or "note"
+        :param file_ids: 文件id列表
+        :return: {已完成的文件id, ...}
+        """
+        file_ids = list(file_ids)
+        done = set()
+        with self.lock:
+            for i in range(0, len(file_ids), 500):
+                part = file_ids[i:i + 500]
+                done.update(j[0] for j in self.conn.execute(
+                    "SELECT file_id FROM file_done WHERE library = ? AND kind = ? AND file_id IN ({})".format(
+                        ",".join("?" * len(part))), [self.library, kind] + part))
+        return done
+
+    def pid_count(self, kind):
+        """
+        已完成的作品数
+        :param kind: "tag" or "note"
+        """
+        with self.lock:
+            return self.conn.execute(
+                "SELECT count(*) FROM pid_done WHERE library = ? AND kind = ?", (self.library, kind)).fetchone()[0]
+
+    def mark(self, kind, file_ids, pids=()):
+        """
+        记录已完成的文件与作品，应在内容提交至数据库之后调用
+        :param kind: "tag" or "note"
+        :param file_ids: 已完成的文件id
+        :param pids: 已完成的作品pid
+        """
+        with self.lock:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO file_done (library, kind, file_id) VALUES (?,?,?)",
+                [(self.library, kind, i) for i in file_ids])
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO pid_done (library, kind, pid) VALUES (?,?,?)",
+                [(self.library, kind, i) for i in pids])
+            self.conn.execute("COMMIT")
+
+    def clear(self):
+        """
+        全部完成后清除该素材库的进度记录
+        """
+        with self.lock:
+            self.conn.execute("DELETE FROM file_done WHERE library = ?", (self.library,))
+            self.conn.execute("DELETE FROM pid_done WHERE library = ?", (self.library,))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
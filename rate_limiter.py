@@ -0,0 +1,120 @@
+# coding=utf8
+
+"""
+一个全局共用的自适应令牌桶限速器,
+请求成功时缓慢提高速率, 遇到 429/403/超时 时速率减半并指数退避(带随机抖动),
+服务器返回 Retry-After 时至少等待该时长.
+"""
+
+import random
+import threading
+import time
+
+# 视为被限流的http状态码
+LIMIT_STATUS = (403, 429)
+
+
+def parse_retry_after(value):
+    """
+    解析 Retry-After 响应头，只支持秒数形式
+    :param value: 响应头内容
+    :return: 秒数 or None
+    """
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+
+    def __init__(self, rate, min_rate=1, max_rate=None, burst=1, backoff_base=1.0, backoff_max=300.0):
+        """
+        初始化限速器
+        :param rate: 初始速率(次/秒)
+        :param min_rate: 最低速率
+        :param max_rate: 最高速率，None 为不超过初始速率
+        :param burst: 令牌桶容量，即允许的突发请求数
+        :param backoff_base: 第一次退避的时长(秒)
+        :param backoff_max: 最长退避时长(秒)
+        """
+        self.rate = float(rate)
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate or rate)
+        self.burst = burst
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lock = threading.Lock()
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        # 退避结束的时间点
+        self.backoff_until = 0.0
+        # 连续被限流的次数，决定退避时长
+        self.fail_num = 0
+        # 被限流的总次数
+        self.limited_count = 0
+
+    def reserve(self):
+        """
+        预约一个令牌
+        :return: 发出请求前需要等待的秒数
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # 令牌可以透支，透支部分按当前速率折算为等待时间
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.backoff_until - now)
+
+    def acquire(self):
+        """
+        阻塞直至可以发出请求
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def on_success(self):
+        """
+        请求成功，加性提高速率，并重置退避
+        """
+        with self.lock:
+            self.fail_num = 0
+            self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+
+    def on_limited(self, retry_after=None):
+        """
+        被限流(429/403)或请求超时，速率减半并退避
+        :param retry_after: 服务器要求等待的秒数
+        """
+        with self.lock:
+            self.limited_count += 1
+            now = time.monotonic()
+            # 同一次退避期间内，其他在途请求的限流不再重复减速
+            if now < self.backoff_until:
+                if retry_after is not None:
+                    self.backoff_until = max(self.backoff_until, now + retry_after)
+                return
+            self.fail_num += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+            backoff = min(self.backoff_max, self.backoff_base * 2 ** (self.fail_num - 1))
+            backoff *= random.uniform(0.5, 1.5)
+            if retry_after is not None:
+                backoff = max(backoff, retry_after)
+            self.backoff_until = now + backoff
+
+    def state(self):
+        """
+        当前限速状态
+        :return: {"rate": 速率, "backoff": 剩余退避秒数, "fail_num": 连续限流次数, "limited": 限流总次数}
+        """
+        with self.lock:
+            return {
+                "rate": round(self.rate, 2),
+                "backoff": round(max(0.0, self.backoff_until - time.monotonic()), 2),
+                "fail_num": self.fail_num,
+                "limited": self.limited_count,
+            }
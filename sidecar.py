@@ -0,0 +1,185 @@
+# coding=utf8
+
+"""
+下载工具保存的本地元数据,
+扫描目录(包括子目录)中以pid开头的 .json/.txt 文件并按pid建立索引,
+支持 /ajax/illust 的原始返回内容、gallery-dl(--write-metadata)、PixivUtil2 的 JSON 与 txt,
+读取时转换为与 /ajax/illust 相同的结构, 可直接交给 illust_parser 解析.
+"""
+
+import json
+import os
+import re
+import threading
+
+# 文件名以pid开头，如 12345_p0.json 12345_p0.png.json 12345.txt
+NAME_RE = re.compile(r"^(\d+)(?:[_\-.]|$)")
+SUFFIXES = (".json", ".txt")
+
+
+# 统一键名
+def normalize_keys(data):
+    """
+    键转为小写并去除空格与下划线，如 "Artist ID" "artist_id" 均为 "artistid"
+    """
+    return {re.sub(r"[\s_]", "", str(k)).lower(): v for k, v in data.items()}
+
+
+# 取第一个存在的键
+def first(data, *keys):
+    for key in keys:
+        if data.get(key) not in (None, ""):
+            return data[key]
+    return None
+
+
+# 读取标签
+def parse_tags(value):
+    """
+    :param value: /ajax/illust 的 {"tags": [...]}，或 [标签名 or {"name"/"tag", "translated_name"/"translation"}]，
+                  或逗号分隔的字符串
+    :return: [{"tag": 标签名, "translation": {"en": 翻译}}, ...]
+    """
+    if isinstance(value, dict):
+        value = value.get("tags")
+    if isinstance(value, str):
+        value = [i.strip() for i in value.split(",")]
+    tags = []
+    for i in value or []:
+        if isinstance(i, dict):
+            name = i.get("tag") or i.get("name")
+            translation = i.get("translation") or i.get("translated_name")
+            if isinstance(translation, str):
+                translation = {"en": translation}
+        else:
+            name, translation = i, None
+        if not name:
+            continue
+        tag = {"tag": str(name)}
+        if isinstance(translation, dict) and translation.get("en"):
+            tag["translation"] = {"en": translation["en"]}
+        tags.append(tag)
+    return tags
+
+
+# 读取 PixivUtil2 的 txt
+def parse_txt(text):
+    """
+    读取 "键 = 值" 形式的行
+    :return: dict
+    """
+    data = {}
+    for line in text.splitlines():
+        key, sep, value = line.partition("=")
+        if sep and key.strip():
+            data.setdefault(key.strip(), value.strip())
+    return data
+
+
+# 转换为 /ajax/illust 的返回结构
+def to_illust(data, pid):
+    """
+    :param data: 元数据 dict
+    :param pid: pixiv插画id，与元数据中的作品id不一致时视为无效
+    :return: dict or None (无法识别)
+    """
+    # /ajax/illust 的原始返回内容
+    if isinstance(data.get("body"), dict) and "error" in data:
+        if data["error"]:
+            return None
+        data = data["body"]
+    data = normalize_keys(data)
+    work_id = first(data, "illustid", "imageid", "id")
+    if work_id is not None and str(work_id) != str(pid):
+        return None
+    title = first(data, "illusttitle", "title")
+    if title is None:
+        return None
+    user = data.get("user") if isinstance(data.get("user"), dict) else {}
+    try:
+        bookmark = int(first(data, "bookmarkcount", "totalbookmarks") or 0)
+    except (TypeError, ValueError):
+        bookmark = 0
+    return {
+        "error": False,
+        "message": "",
+        "body": {
+            "illustId": str(pid),
+            "illustTitle": str(title),
+            "userId": str(first(data, "userid", "artistid") or user.get("id", "")),
+            "userName": str(first(data, "username", "artistname") or user.get("name", "")),
+            "bookmarkCount": bookmark,
+            "illustComment": str(first(data, "illustcomment", "caption", "description") or ""),
+            "tags": {"tags": parse_tags(data.get("tags"))},
+        },
+    }
+
+
+class SidecarIndex:
+
+    def __init__(self, paths):
+        """
+        扫描目录并建立索引，只记录文件路径，读取时才解析
+        :param paths: 目录列表
+        """
+        self.paths = list(paths)
+        self.lock = threading.Lock()
+        # pid -> [文件路径, ...] .json 在前
+        self.index = {}
+        # 命中/未命中/无法识别 计数
+        self.hit = 0
+        self.miss = 0
+        self.invalid = 0
+        for path in self.paths:
+            self.scan(path)
+        for files in self.index.values():
+            files.sort(key=lambda i: not i.endswith(".json"))
+
+    def __len__(self):
+        return len(self.index)
+
+    def scan(self, path):
+        """
+        :param path: 目录
+        """
+        for root, _, names in os.walk(path):
+            for name in names:
+                if not name.lower().endswith(SUFFIXES):
+                    continue
+                match = NAME_RE.match(name)
+                if match:
+                    self.index.setdefault(match.group(1), []).append(os.path.join(root, name))
+
+    def load(self, path, pid):
+        """
+        读取一个元数据文件
+        :return: /ajax/illust 结构的 dict or None (无法识别)
+        """
+        try:
+            with open(path, encoding="utf-8-sig", errors="replace") as f:
+                text = f.read()
+            data = json.loads(text) if path.lower().endswith(".json") else parse_txt(text)
+        except (OSError, ValueError):
+            return None
+        return to_illust(data, pid) if isinstance(data, dict) else None
+
+    def get(self, pid):
+        """
+        读取作品的本地元数据
+        :param pid: pixiv插画id
+        :return: (200, text) text 为 /ajax/illust 结构的 JSON，or None (没有可用的元数据)
+        """
+        json_data = None
+        invalid = 0
+        for path in self.index.get(str(pid), ()):
+            json_data = self.load(path, pid)
+            if json_data is not None:
+                break
+            invalid += 1
+        with self.lock:
+            self.invalid += invalid
+            if json_data is None:
+                self.miss += 1
+                return None
+            self.hit += 1
+        return 200, json.dumps(json_data, ensure_ascii=False)
@@ -0,0 +1,61 @@
+# coding=utf8
+
+"""
+线程安全的标签索引,
+保存 标签名 -> 标签id, 由数据库中已有的标签初始化,
+新标签的id由写入线程在写入事务中交给数据库分配, 提交成功后再加入索引,
+因此不会与Billfish等其他程序同时创建的标签冲突.
+"""
+
+import threading
+
+
+class TagIndex:
+
+    def __init__(self, rows):
+        """
+        :param rows: 数据库中已有的标签 [(id, name), ...]
+        """
+        self.lock = threading.Lock()
+        self.index = self.build(rows)
+
+    @staticmethod
+    def build(rows):
+        index = {}
+        for tag_id, name in rows:
+            index.setdefault(name, tag_id)
+        return index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, name, alias=None):
+        """
+        查找标签id
+        :param name: 标签名
+        :param alias: 函数，返回标签的另一种名称(如去除 Artist: 前缀)或 None，优先查找
+        :return: tag_id or None
+        """
+        with self.lock:
+            if alias is not None:
+                other = alias(name)
+                if other is not None and other in self.index:
+                    return self.index[other]
+            return self.index.get(name)
+
+    def update(self, tags):
+        """
+        加入已提交的标签
+        :param tags: {标签名: 标签id}
+        """
+        with self.lock:
+            self.index.update(tags)
+
+    def reset(self, rows):
+        """
+        按数据库中当前的标签重建索引，用于其他程序(如Billfish)修改、删除过标签之后
+        :param rows: [(id, name), ...]
+        """
+        index = self.build(rows)
+        with self.lock:
+            self.index = index
@@ -3,13 +3,15 @@
 """
 一个基于thread和queue的线程池,
 任务为队列元素,动态创建线程并重复利用.
-通过close和terminate关闭线程池.
+任务队列有长度上限, 队列已满时 put 会等待, 以此限制放入任务的速度.
+put 返回 concurrent.futures.Future, 可获取任务的返回值或异常.
+通过close(等待全部任务完成)和terminate(取消未开始的任务)关闭线程池.
 """
 
 import queue
 import threading
-import contextlib
 import time
+from concurrent.futures import Future
 
 # 创建空对象,用于停止线程
 StopEvent = object()
@@ -19,7 +21,7 @@ def callback(status, result):
     """
     根据需要进行的回调函数，默认不执行。
     :param status: action函数的执行状态
-    :param result: action函数的返回值
+    :param result: action函数的返回值，执行失败时为异常对象
     :return:
     """
     pass
@@ -43,165 +45,143 @@ class ThreadPool:
         """
         初始化线程池
         :param max_num: 线程池最大线程数量
-        :param max_task_num: 任务队列长度
+        :param max_task_num: 任务队列长度，None或0为不限制
         """
-        # 如果提供了最大任务数的参数，则将队列的最大元素个数设置为这个值。
-        max_task_num = 20
-        if max_task_num:
-            self.q = queue.Queue(max_task_num)
-        # 默认队列可接受无限多个的任务
-        else:
-            self.q = queue.Queue()
-        # print("创建好队列了")
+        self.q = queue.Queue(max_task_num or 0)
         # 设置线程池最多可实例化的线程数
         self.max_num = max_num
-        # 任务取消标识
+        self.max_task_num = max_task_num
+        # 保护线程列表与计数
+        self.lock = threading.Lock()
+        # 不再接受新任务
         self.cancel = False
-        # 任务中断标识
-        self.terminal = False
-        # 已实例化的线程列表
+        # 已实例化的线程
         self.generate_list = []
-        # 处于空闲状态的线程列表
-        self.free_list = []
+        # 正在等待任务的空闲线程数
+        self.free_num = 0
+        # 执行成功/失败的任务数
+        self.success_count = 0
+        self.fail_count = 0
 
     def put(self, func, args, callback=None):
         """
-        往任务队列里放入一个任务
+        往任务队列里放入一个任务，队列已满时等待
         :param func: 任务函数
         :param args: 任务函数所需参数
         :param callback: 任务执行失败或成功后执行的回调函数，回调函数有两个参数
-        1、任务函数执行状态；2、任务函数返回值（默认为None，即：不执行回调函数）
-        :return: 如果线程池已经终止，则返回True否则None
+        1、任务函数执行状态；2、任务函数返回值或异常（默认为None，即：不执行回调函数）
+        :return: Future，线程池已关闭时返回None
         """
-        # 先判断标识，看看任务是否取消了
         if self.cancel:
-            return
-        # 如果没有空闲的线程，并且已创建的线程的数量小于预定义的最大线程数，则创建新线程。
-        if len(self.free_list) == 0 and len(self.generate_list) < self.max_num:
-            self.generate_thread()
-        # 构造任务参数元组，分别是调用的函数，该函数的参数，回调函数。
-        w = (func, args, callback,)
-        # 将任务放入队列
-        self.q.put(w)
+            return None
+        future = Future()
+        with self.lock:
+            # 如果没有空闲的线程，并且已创建的线程的数量小于预定义的最大线程数，则创建新线程。
+            if self.free_num == 0 and len(self.generate_list) < self.max_num:
+                self.generate_thread()
+        self.q.put((func, args, callback, future))
+        return future
 
     def generate_thread(self):
         """
-        创建一个线程
+        创建一个线程，需持有 lock
         """
-        # 每个线程都执行call方法
-        t = threading.Thread(target=self.call)
+        t = threading.Thread(target=self.call, name=f"ThreadPool-{len(self.generate_list)}", daemon=True)
+        self.generate_list.append(t)
         t.start()
 
     def call(self):
         """
-        循环去获取任务函数并执行任务函数。在正常情况下，每个线程都保存生存状态,直到获取线程终止的flag。
+        循环获取任务并执行，直至获取到终止线程的标识
         """
-        # 获取当前线程的名字
-        current_thread = threading.currentThread().getName()
-        # 将当前线程的名字加入已实例化的线程列表中
-        self.generate_list.append(current_thread)
-        # 从任务队列中获取一个任务
-        event = self.q.get()
-        # 让获取的任务不是终止线程的标识对象时
-        while event != StopEvent:
-            # 解析任务中封装的三个参数
-            func, arguments, callback = event
-            # 抓取异常，防止线程因为异常退出
-            try:
-                # 正常执行任务函数
-                result = func(*arguments)
-                # result = func(current_thread, *arguments)
-                success = True
-            except Exception as e:
-                # 当任务执行过程中弹出异常
-                result = None
-                success = False
-            # 如果有指定的回调函数
-            if callback is not None:
-                # 执行回调函数，并抓取异常
+        while True:
+            with self.lock:
+                self.free_num += 1
+            event = self.q.get()
+            with self.lock:
+                self.free_num -= 1
+            if event is StopEvent:
+                break
+            func, arguments, callback, future = event
+            # 已被 terminate 取消的任务不再执行
+            if future.set_running_or_notify_cancel():
                 try:
-                    callback(success, result)
-                except Exception as e:
-                    pass
-            # 当某个线程正常执行完一个任务时，先执行worker_state方法
-            with self.worker_state(self.free_list, current_thread):
-                # 如果强制关闭线程的flag开启，则传入一个StopEvent元素
-                if self.terminal:
-                    event = StopEvent
-                # 否则获取一个正常的任务，并回调worker_state方法的yield语句
+                    result = func(*arguments)
+                    success = True
+                except BaseException as e:
+                    result = e
+                    success = False
+                with self.lock:
+                    if success:
+                        self.success_count += 1
+                    else:
+                        self.fail_count += 1
+                if success:
+                    future.set_result(result)
                 else:
-                    # 从这里开始又是一个正常的任务循环
-                    event = self.q.get()
-        else:
-            # 一旦发现任务是个终止线程的标识元素，将线程从已创建线程列表中删除
-            self.generate_list.remove(current_thread)
-
-    def close(self):
+                    future.set_exception(result)
+                if callback is not None:
+                    try:
+                        callback(success, result)
+                    except Exception:
+                        pass
+
+    def close(self, timeout=None):
         """
-        执行完所有的任务后，让所有线程都停止的方法
+        不再接受新任务，等待队列中的任务全部执行完毕后停止所有线程
+        :param timeout: 最长等待秒数，None为一直等待
+        :return: 所有线程是否均已停止
         """
-        # 设置flag
         self.cancel = True
-        # 计算已创建线程列表中线程的个数，
-        # 然后往任务队列里推送相同数量的终止线程的标识元素
-        full_size = len(self.generate_list)
-        while full_size:
+        with self.lock:
+            threads = list(self.generate_list)
+        # 终止标识排在已有任务之后，线程执行完前面的任务才会停止
+        for _ in threads:
             self.q.put(StopEvent)
-            full_size -= 1
+        return self.join(threads, timeout)
 
-    def terminate(self):
+    def terminate(self, timeout=None):
         """
-        在任务执行过程中，终止线程，提前退出。
+        取消尚未开始的任务，等待正在执行的任务结束后停止所有线程
+        :param timeout: 最长等待秒数，None为一直等待
+        :return: 所有线程是否均已停止
         """
-        self.terminal = True
-        # 强制性的停止线程
-        while self.generate_list:
+        self.cancel = True
+        while True:
+            try:
+                event = self.q.get_nowait()
+            except queue.Empty:
+                break
+            if event is not StopEvent:
+                event[3].cancel()
+        with self.lock:
+            threads = list(self.generate_list)
+        for _ in threads:
             self.q.put(StopEvent)
+        return self.join(threads, timeout)
 
-    # 该装饰器用于上下文管理
-    @contextlib.contextmanager
-    def worker_state(self, state_list, worker_thread):
+    @staticmethod
+    def join(threads, timeout=None):
         """
-        用于记录空闲的线程，或从空闲列表中取出线程处理任务
+        等待线程结束
+        :param threads: 线程列表
+        :param timeout: 最长等待秒数，None为一直等待
+        :return: 所有线程是否均已停止
         """
-        # 将当前线程，添加到空闲线程列表中
-        state_list.append(worker_thread)
-        # 捕获异常
-        try:
-            # 在此等待
-            yield
-        finally:
-            # 将线程从空闲列表中移除
-            state_list.remove(worker_thread)
+        end = None if timeout is None else time.monotonic() + timeout
+        for t in threads:
+            t.join(None if end is None else max(0.0, end - time.monotonic()))
+        return not any(t.is_alive() for t in threads)
 
-"""
 
 # 调用方式
 if __name__ == '__main__':
-    # 创建一个最多包含5个线程的线程池
-    # pool = ThreadPool(5)
-
-    # 创建100个任务，让线程池进行处理
-    # for i in range(100):
-    #     pool.put(action, (i,), callback)
-    
-    # 等待一定时间，让线程执行任务
-    # time.sleep(3)
-
-    print("-" * 50)
-    while True:
-        print("\033[32;0m任务停止之前线程池中有%s个线程，空闲的线程有%s个！\033[0m"
-              % (len(pool.generate_list), len(pool.free_list)))
-
-        if len(pool.free_list) == pool.max_num and len(pool.generate_list) == 5:
-            # 正常关闭线程池
-            pool.close()
-            print("任务执行完毕，正常退出！")
-            break
-
-        time.sleep(1)
-    # 强制关闭线程池
-    # pool.terminate()
-    # print("强制停止任务！")
-
-"""
\ No newline at end of file
+    # 创建一个最多包含5个线程，任务队列长度为10的线程池
+    pool = ThreadPool(5, 10)
+
+    # 创建100个任务，队列已满时 put 会等待
+    futures = [pool.put(action, ("main", i), callback) for i in range(100)]
+
+    # 等待所有任务执行完毕后关闭线程池
+    pool.close()
+    print("任务执行完毕，成功%s个，失败%s个，正常退出！" % (pool.success_count, pool.fail_count))